@@ -5,8 +5,489 @@
 #
 # This script performs clustering on the registered stacks of elemental maps. It is based on that every pixel in the registered stack is a part of a time series
 # Thus it segments each stack into spatial regions that show similar behavior over time.
-# Saves the labels as labels.npy
+# Saves the labels in the stack file under /clustering/kmeans_<K>/labels
 # Based on a JSON file, an X number of clusters will be computed.
+# The stacks are never loaded as a whole. Blocks of rows are streamed from /registered/line_intensities,
+# normalised with statistics from a first streaming pass (ignoring NaN), and fed to MiniBatchKMeans.partial_fit.
+# All numbers of clusters are fitted in the same passes over the data.
+# With source='features' the per-pixel features of pixel_features.py (cached in the stack file) are clustered instead of the raw time series.
+# Hierarchical (Ward) clustering only merges neighbouring pixels (4 or 8 neighbours), which keeps memory and time
+# near-linear in the number of pixels. The full merge tree is stored once under /clustering/ward, and any number of clusters
+# is a cheap cut of the tree (cut_tree).
+# To choose the number of clusters, sweep() loads the pixels once into shared memory and fits all numbers of clusters in parallel
+# worker processes, scoring each with the inertia and the silhouette of a stratified pixel sample. Results go to /clustering/sweep.
 # clustering()
 # KMeans()
-# Hierarchical() # maybe implement sometime
\ No newline at end of file
+# Hierarchical()
+# sweep()
+import os
+import time
+import json
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+import pymongo
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import MiniBatchKMeans, ward_tree
+from sklearn.metrics import silhouette_score
+from threadpoolctl import threadpool_limits
+from typing import List, Dict, Tuple
+from stack_io import row_blocks, iter_pixel_blocks, pixel_statistics, normalise_block, registration_state
+from pixel_features import ensure_features
+
+
+def fit_kmeans(datasets : List[h5py.Dataset], n_clusters : List[int], batch_size : int = 4096, n_epochs : int = 3, block_rows : int = 16,
+               per_frame : bool = False, min_valid_fraction : float = 0.5, random_state : int = 0) -> Tuple[Dict[int, MiniBatchKMeans], np.ndarray, np.ndarray]:
+    """
+    Fits one MiniBatchKMeans model per number of clusters, streaming blocks of rows from the datasets.
+    Every epoch visits the blocks in random order and the pixels of a block in random order,
+    and every mini batch is passed to partial_fit of all models, so the data is read n_epochs times regardless of the number of models.
+
+    Args:
+    - datasets (List[h5py.Dataset]) : datasets of shape (frames, rows, cols)
+    - n_clusters (List[int]) : numbers of clusters to fit
+    - batch_size (int) : pixels per partial_fit call. Default 4096
+    - n_epochs (int) : passes over the data. Default 3
+    - block_rows (int) : rows read at once. Default 16
+    - per_frame (bool) : see pixel_statistics. Default False
+    - min_valid_fraction (float) : see normalise_block. Default 0.5
+    - random_state (int) : seed of the pixel order and of the models. Default 0
+
+    Returns:
+    - models (Dict[int, MiniBatchKMeans]) : fitted model per number of clusters
+    - mean, std (np.ndarray) : normalisation, needed to predict labels
+    """
+    rng = np.random.default_rng(random_state)
+    n_pixels = datasets[0].shape[1]*datasets[0].shape[2]
+    t0 = time.time()
+    mean, std = pixel_statistics(datasets, block_rows, per_frame)
+    dt = time.time() - t0
+    print(f'Normalisation: {n_pixels} pixels in {dt:.1f} s ({n_pixels/dt:.0f} px/s)')
+
+    models = {k: MiniBatchKMeans(n_clusters=k, batch_size=batch_size, random_state=random_state) for k in n_clusters}
+    n_blocks = len(row_blocks(datasets[0].shape[1], block_rows))
+    pending = None # valid pixels left over from the previous block, so that every partial_fit call gets a full batch
+    for epoch in range(n_epochs):
+        t0 = time.time()
+        for _, X in iter_pixel_blocks(datasets, block_rows, order=rng.permutation(n_blocks)):
+            X, valid = normalise_block(X, mean, std, min_valid_fraction)
+            X = X[valid]
+            X = X[rng.permutation(len(X))]
+            if pending is not None:
+                X = np.concatenate((pending, X), axis=0)
+            n_full = (len(X)//batch_size)*batch_size
+            for start in range(0, n_full, batch_size):
+                for model in models.values():
+                    model.partial_fit(X[start:start + batch_size])
+            pending = X[n_full:]
+        # the last incomplete batch of the epoch. The first call to partial_fit needs at least k pixels
+        if pending is not None and len(pending) and all(hasattr(model, 'cluster_centers_') or len(pending) >= k for k, model in models.items()):
+            for model in models.values():
+                model.partial_fit(pending)
+            pending = None
+        dt = time.time() - t0
+        print(f'Epoch {epoch + 1}/{n_epochs}: {n_pixels} pixels, {len(models)} models in {dt:.1f} s ({n_pixels/dt:.0f} px/s)')
+    return models, mean, std
+
+
+def predict_labels(datasets : List[h5py.Dataset], models : Dict[int, MiniBatchKMeans], mean : np.ndarray, std : np.ndarray,
+                   block_rows : int = 16, min_valid_fraction : float = 0.5) -> Tuple[Dict[int, np.ndarray], Dict[int, float]]:
+    """
+    Streams over the datasets once more and labels every pixel with all models.
+
+    Returns:
+    - labels (Dict[int, np.ndarray]) : (rows, cols) int32 label map per number of clusters. Invalid pixels are labelled -1
+    - inertia (Dict[int, float]) : sum of squared distances of all valid pixels to their cluster centre, per number of clusters.
+        (model.inertia_ after partial_fit only covers the last mini-batch)
+    """
+    shape = datasets[0].shape[1:]
+    labels = {k: np.full(shape, -1, dtype=np.int32) for k in models}
+    inertia = {k: 0.0 for k in models}
+    t0 = time.time()
+    for rows, X in iter_pixel_blocks(datasets, block_rows):
+        X, valid = normalise_block(X, mean, std, min_valid_fraction)
+        for k, model in models.items():
+            block_labels = np.full(len(X), -1, dtype=np.int32)
+            if valid.any():
+                distances = model.transform(X[valid])
+                block_labels[valid] = distances.argmin(axis=1)
+                inertia[k] += float(np.square(distances.min(axis=1), dtype=np.float64).sum())
+            labels[k][rows] = block_labels.reshape(-1, shape[1])
+    dt = time.time() - t0
+    n_pixels = shape[0]*shape[1]
+    print(f'Labelling: {n_pixels} pixels, {len(models)} models in {dt:.1f} s ({n_pixels/dt:.0f} px/s)')
+    return labels, inertia
+
+
+def save_labels(f : h5py.File, labels : np.ndarray, model : MiniBatchKMeans, mean : np.ndarray, std : np.ndarray, inertia : float, attrs : dict) -> None:
+    """Stores a label map, the cluster centres (in normalised units) and the inertia of all pixels (see predict_labels)
+    under /clustering/kmeans_<K> in an opened stack file"""
+    group_path = f'/clustering/kmeans_{model.n_clusters}'
+    if group_path in f:
+        del f[group_path]
+    g = f.create_group(group_path)
+    g.create_dataset('labels', data=labels)
+    g.create_dataset('cluster_centers', data=model.cluster_centers_)
+    g.create_dataset('mean', data=mean)
+    g.create_dataset('std', data=std)
+    g.attrs['inertia'] = inertia
+    g.attrs.update(attrs)
+
+
+def clustering_datasets(f : h5py.File, elements : List[str], source : str = 'raw', features : dict = None) -> List[h5py.Dataset]:
+    """
+    Returns the (features, rows, cols) datasets to cluster from an opened stack file.
+    source 'raw' gives the registered stacks of the elements, 'features' the features of pixel_features.py,
+    which are calculated and cached first if needed (features are the arguments of pixel_features.compute_features).
+    The registered stacks must be materialised: clustering streams blocks of rows, and a registered_stack.RegisteredStack
+    would warp every frame again for every block.
+    """
+    state = registration_state(f)
+    if state != 'materialised':
+        reason = 'only has the transforms' if state == 'transforms' else 'is not registered'
+        raise ValueError(f'{f.filename} {reason}, run stack_registration.register_stacks with materialise=True first')
+    if source == 'raw':
+        return [f[f'/registered/line_intensities/{element}'] for element in elements]
+    elif source == 'features':
+        return ensure_features(f, elements, **(features or {}))
+    raise ValueError(f'Unknown source {source}')
+
+
+def KMeans(file_path : str, elements : List[str], n_clusters : List[int], batch_size : int = 4096, n_epochs : int = 3, block_rows : int = 16,
+           per_frame : bool = False, min_valid_fraction : float = 0.5, random_state : int = 0, source : str = 'raw', features : dict = None) -> Dict[int, np.ndarray]:
+    """
+    Clusters the registered stacks of the elements in a stack file with MiniBatchKMeans, for each number of clusters,
+    and stores the label maps in the stack file. See fit_kmeans for the arguments.
+    With source='features' the cached per-pixel features are clustered instead (see clustering_datasets),
+    each feature normalised separately.
+
+    Returns:
+    - labels (Dict[int, np.ndarray]) : (rows, cols) label map per number of clusters
+    """
+    t0 = time.time()
+    with h5py.File(file_path, 'r+') as f:
+        datasets = clustering_datasets(f, elements, source, features)
+        if source == 'features':
+            # features have different units, normalise each of them
+            per_frame = True
+        models, mean, std = fit_kmeans(datasets, n_clusters, batch_size, n_epochs, block_rows, per_frame, min_valid_fraction, random_state)
+        labels, inertia = predict_labels(datasets, models, mean, std, block_rows, min_valid_fraction)
+        attrs = {'elements': elements, 'source': source, 'n_epochs': n_epochs, 'batch_size': batch_size, 'per_frame': per_frame,
+                 'min_valid_fraction': min_valid_fraction, 'random_state': random_state}
+        for k, model in models.items():
+            save_labels(f, labels[k], model, mean, std, inertia[k], attrs)
+    dt = time.time() - t0
+    n_pixels = labels[n_clusters[0]].size
+    print(f'Clustered {n_pixels} pixels into {n_clusters} clusters in {dt:.1f} s ({n_pixels/dt:.0f} px/s overall)')
+    return labels
+
+
+NEIGHBOUR_OFFSETS = {4: [(0, 1), (1, 0)], 8: [(0, 1), (1, 0), (1, 1), (1, -1)]}
+
+
+def pixel_connectivity(valid : np.ndarray, neighbours : int = 4) -> scipy.sparse.csr_matrix:
+    """
+    Sparse connectivity graph between the valid pixels of a map, connecting each pixel to its 4 or 8 neighbours.
+
+    Args:
+    - valid (np.ndarray) : (rows, cols) boolean map of the pixels to connect
+    - neighbours (int) : 4 or 8. Default 4
+
+    Returns:
+    - connectivity (scipy.sparse.csr_matrix) : symmetric (n_valid, n_valid) matrix, pixels in row-major order of np.flatnonzero(valid)
+    """
+    n_rows, n_cols = valid.shape
+    index = np.full(valid.shape, -1, dtype=np.int64)
+    index[valid] = np.arange(valid.sum())
+    sources, targets = [], []
+    for d_row, d_col in NEIGHBOUR_OFFSETS[neighbours]:
+        # pairs of pixels (r, c) and (r + d_row, c + d_col) that are both inside the map
+        first_col, stop_col = max(0, -d_col), n_cols - max(0, d_col)
+        a = index[:n_rows - d_row, first_col:stop_col]
+        b = index[d_row:, first_col + d_col:stop_col + d_col]
+        both = (a >= 0) & (b >= 0)
+        sources.append(a[both])
+        targets.append(b[both])
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+    n = int(valid.sum())
+    graph = scipy.sparse.coo_matrix((np.ones(len(sources)), (sources, targets)), shape=(n, n))
+    return (graph + graph.T).tocsr()
+
+
+def read_pixels(datasets : List[h5py.Dataset], per_frame : bool = False, min_valid_fraction : float = 0.5, block_rows : int = 16) -> Tuple[np.ndarray, np.ndarray]:
+    """Reads the normalised pixel matrix of the valid pixels into memory, streaming blocks of rows.
+    Returns X (valid pixels, features) and the (rows, cols) map of valid pixels"""
+    mean, std = pixel_statistics(datasets, block_rows, per_frame)
+    valid_map = np.zeros(datasets[0].shape[1:], dtype=bool)
+    blocks = []
+    for rows, X in iter_pixel_blocks(datasets, block_rows):
+        X, valid = normalise_block(X, mean, std, min_valid_fraction)
+        valid_map[rows] = valid.reshape(-1, valid_map.shape[1])
+        blocks.append(X[valid])
+    return np.concatenate(blocks, axis=0), valid_map
+
+
+def fit_ward_tree(X : np.ndarray, valid : np.ndarray, neighbours : int = 4) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Ward clustering of the pixels where only neighbouring clusters can merge.
+
+    Args:
+    - X (np.ndarray) : (valid pixels, features) pixel matrix, in row-major order of the valid map
+    - valid (np.ndarray) : (rows, cols) map of the valid pixels
+    - neighbours (int) : 4 or 8, see pixel_connectivity. Default 4
+
+    Returns:
+    - children (np.ndarray) : (n - 1, 2) merges. Node i < n is pixel i, node n + j is the cluster created by merge j
+    - distances (np.ndarray) : Ward distance of each merge
+    """
+    connectivity = pixel_connectivity(valid, neighbours)
+    # ward_tree connects separate components of the graph itself, so the tree always ends in a single cluster
+    children, _, _, _, distances = ward_tree(X, connectivity=connectivity, return_distance=True)
+    return children, distances
+
+
+def tree_representatives(children : np.ndarray, n_leaves : int) -> np.ndarray:
+    """For every node of the merge tree, one pixel (leaf) inside it. Computed once per tree, used by cut_tree"""
+    representatives = np.empty(n_leaves + len(children), dtype=np.int64)
+    representatives[:n_leaves] = np.arange(n_leaves)
+    for j, (a, b) in enumerate(children):
+        representatives[n_leaves + j] = representatives[a]
+    return representatives
+
+
+def cut_tree(children : np.ndarray, n_leaves : int, n_clusters : int, representatives : np.ndarray = None) -> np.ndarray:
+    """
+    Labels of the leaves when the merge tree is cut into n_clusters clusters, i.e. after the first n_leaves - n_clusters merges.
+    Every merge joins the representative pixels of its two children, and the clusters are the connected components of these joins,
+    so no clustering is repeated.
+
+    Returns:
+    - labels (np.ndarray) : label of each leaf, from 0 to n_clusters - 1
+    """
+    if representatives is None:
+        representatives = tree_representatives(children, n_leaves)
+    merges = children[:max(n_leaves - n_clusters, 0)]
+    joins = scipy.sparse.coo_matrix((np.ones(len(merges)), (representatives[merges[:, 0]], representatives[merges[:, 1]])),
+                                    shape=(n_leaves, n_leaves))
+    _, labels = connected_components(joins, directed=False)
+    return labels.astype(np.int32)
+
+
+def load_ward_tree(f : h5py.File) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Loads the merge tree stored by Hierarchical: children, distances and the (rows, cols) map of the clustered pixels"""
+    g = f['/clustering/ward']
+    return g['children'][()], g['distances'][()], g['valid'][()]
+
+
+def ward_labels(f : h5py.File, n_clusters : List[int]) -> Dict[int, np.ndarray]:
+    """Label maps for any numbers of clusters from the merge tree stored in an opened stack file. Pixels that were not clustered are -1"""
+    children, _, valid = load_ward_tree(f)
+    n_leaves = len(children) + 1
+    representatives = tree_representatives(children, n_leaves)
+    labels = {}
+    for k in n_clusters:
+        label_map = np.full(valid.shape, -1, dtype=np.int32)
+        label_map[valid] = cut_tree(children, n_leaves, k, representatives)
+        labels[k] = label_map
+    return labels
+
+
+def Hierarchical(file_path : str, elements : List[str], n_clusters : List[int], neighbours : int = 4, block_rows : int = 16,
+                 per_frame : bool = False, min_valid_fraction : float = 0.5, source : str = 'raw', features : dict = None) -> Dict[int, np.ndarray]:
+    """
+    Spatially constrained Ward clustering of a stack file. The merge tree is stored under /clustering/ward,
+    and the label map of every number of clusters under /clustering/ward_<K>/labels.
+    Later cuts can be made from the stored tree with ward_labels, without clustering again.
+    See KMeans for source and features, and pixel_connectivity for neighbours.
+
+    Returns:
+    - labels (Dict[int, np.ndarray]) : (rows, cols) label map per number of clusters
+    """
+    t0 = time.time()
+    with h5py.File(file_path, 'r+') as f:
+        datasets = clustering_datasets(f, elements, source, features)
+        if source == 'features':
+            per_frame = True
+        X, valid = read_pixels(datasets, per_frame, min_valid_fraction, block_rows)
+        children, distances = fit_ward_tree(X, valid, neighbours)
+        if '/clustering/ward' in f:
+            del f['/clustering/ward']
+        g = f.create_group('/clustering/ward')
+        g.create_dataset('children', data=children)
+        g.create_dataset('distances', data=distances)
+        g.create_dataset('valid', data=valid)
+        attrs = {'elements': elements, 'source': source, 'neighbours': neighbours, 'per_frame': per_frame, 'min_valid_fraction': min_valid_fraction}
+        g.attrs.update(attrs)
+        dt = time.time() - t0
+        print(f'Ward tree of {len(X)} pixels in {dt:.1f} s ({len(X)/dt:.0f} px/s)')
+
+        labels = ward_labels(f, n_clusters)
+        for k, label_map in labels.items():
+            group_path = f'/clustering/ward_{k}'
+            if group_path in f:
+                del f[group_path]
+            f.create_group(group_path).create_dataset('labels', data=label_map)
+            f[group_path].attrs.update(attrs)
+    return labels
+
+
+def stratified_sample(labels : np.ndarray, sample_size : int, rng : np.random.Generator) -> np.ndarray:
+    """Indices of about sample_size pixels with the same number from every cluster (or all pixels of clusters that are smaller)"""
+    per_cluster = max(1, sample_size//(labels.max() + 1))
+    indices = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        indices.append(rng.choice(members, min(per_cluster, len(members)), replace=False))
+    return np.sort(np.concatenate(indices))
+
+
+_shared = {}
+
+
+def _init_sweep_worker(name : str, shape : tuple, dtype : str, threads : int) -> None:
+    # attach to the pixel matrix in shared memory once per worker, and keep the BLAS/OpenMP threads per worker low
+    shm = shared_memory.SharedMemory(name=name)
+    _shared['shm'] = shm
+    _shared['X'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _shared['limits'] = threadpool_limits(threads)
+
+
+def _sweep_one(args : tuple) -> Tuple[int, np.ndarray, float, float, float]:
+    k, batch_size, sample_size, random_state = args
+    X = _shared['X']
+    t0 = time.time()
+    model = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, random_state=random_state, n_init=3).fit(X)
+    labels = model.labels_.astype(np.int32)
+    sample = stratified_sample(labels, sample_size, np.random.default_rng(random_state))
+    silhouette = silhouette_score(X[sample], labels[sample]) if len(np.unique(labels[sample])) > 1 else np.nan
+    return k, labels, float(model.inertia_), float(silhouette), time.time() - t0
+
+
+def sweep(file_path : str, elements : List[str], n_clusters : List[int], n_workers : int = None, threads : int = 1, sample_size : int = 10000,
+          batch_size : int = 4096, block_rows : int = 16, per_frame : bool = False, min_valid_fraction : float = 0.5, random_state : int = 0,
+          source : str = 'raw', features : dict = None) -> Dict[str, np.ndarray]:
+    """
+    Fits MiniBatchKMeans for every number of clusters in parallel, to choose the number of clusters.
+    The normalised pixel matrix is read once and put in shared memory, so the worker processes do not copy or re-read it.
+    Every model is scored with its inertia (all pixels) and the silhouette score of a stratified sample of sample_size pixels
+    (the same number from every cluster), instead of the full silhouette which is O(pixels^2).
+    All label maps and scores are stored in the stack file under /clustering/sweep.
+
+    Args:
+    - file_path (str) : stack file
+    - elements (List[str]) : elements to cluster
+    - n_clusters (List[int]) : numbers of clusters to try
+    - n_workers (int) : worker processes. Default is the number of cores, at most the number of models
+    - threads (int) : BLAS/OpenMP threads per worker. Default 1
+    - sample_size (int) : pixels in the silhouette sample. Default 10000
+    - the remaining arguments as in KMeans
+
+    Returns:
+    - results (Dict[str, np.ndarray]) : 'n_clusters', 'labels' (models, rows, cols), 'inertia' and 'silhouette'
+    """
+    t0 = time.time()
+    if source == 'features':
+        per_frame = True
+        # features may have to be calculated and cached first
+        with h5py.File(file_path, 'r+') as f:
+            clustering_datasets(f, elements, source, features)
+    with h5py.File(file_path, 'r') as f:
+        datasets = clustering_datasets(f, elements, source, features)
+        X, valid = read_pixels(datasets, per_frame, min_valid_fraction, block_rows)
+    print(f'Read {len(X)} pixels x {X.shape[1]} features in {time.time() - t0:.1f} s')
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, len(n_clusters)))
+    shm = shared_memory.SharedMemory(create=True, size=X.nbytes)
+    results = {}
+    try:
+        np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[:] = X
+        shape, dtype = X.shape, X.dtype.str
+        del X
+        jobs = [(k, batch_size, sample_size, random_state) for k in n_clusters]
+        # spawn instead of fork, like the registration workers
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx, initializer=_init_sweep_worker, initargs=(shm.name, shape, dtype, threads)) as executor:
+            for k, labels, inertia, silhouette, dt in executor.map(_sweep_one, jobs):
+                print(f'K={k}: inertia {inertia:.4g}, silhouette {silhouette:.3f} ({dt:.1f} s, {shape[0]/dt:.0f} px/s)')
+                results[k] = (labels, inertia, silhouette)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    label_maps = np.full((len(n_clusters),) + valid.shape, -1, dtype=np.int32)
+    for i, k in enumerate(n_clusters):
+        label_maps[i][valid] = results[k][0]
+    out = {'n_clusters': np.array(n_clusters), 'labels': label_maps,
+           'inertia': np.array([results[k][1] for k in n_clusters]), 'silhouette': np.array([results[k][2] for k in n_clusters])}
+    with h5py.File(file_path, 'r+') as f:
+        if '/clustering/sweep' in f:
+            del f['/clustering/sweep']
+        g = f.create_group('/clustering/sweep')
+        for name, data in out.items():
+            g.create_dataset(name, data=data)
+        g.attrs.update({'elements': elements, 'source': source, 'sample_size': sample_size, 'batch_size': batch_size,
+                        'per_frame': per_frame, 'min_valid_fraction': min_valid_fraction, 'random_state': random_state})
+    dt = time.time() - t0
+    best = n_clusters[int(np.nanargmax(out['silhouette']))] if np.isfinite(out['silhouette']).any() else None
+    print(f'Swept {len(n_clusters)} numbers of clusters with {n_workers} workers in {dt:.1f} s, best silhouette at K={best}')
+    return out
+
+
+def clustering(beamline : str, config_path : str, sample_name : str = None, scan_type : str = None) -> None:
+    """
+    Clusters all stacks in the stacks collection matching the query, with the settings of the beamline in the JSON config:
+    - elements : elements whose time series are clustered together
+    - n_clusters : list of numbers of clusters, each gives one label map
+    - the optional keys batch_size, n_epochs, block_rows, per_frame, min_valid_fraction and random_state, see fit_kmeans
+    - source : 'raw' or 'features', and features : the arguments of pixel_features.compute_features, see KMeans
+    - ward : optional, arguments of Hierarchical (e.g. neighbours), to also run spatially constrained Ward clustering
+    - sweep : optional, arguments of sweep (n_clusters to try, n_workers, sample_size), run before the clustering
+    """
+    with open(config_path, 'r') as f:
+        config = json.load(f)[beamline]
+    print(config)
+    ward_config = config.pop('ward', None)
+    sweep_config = config.pop('sweep', None)
+
+    client = pymongo.MongoClient('mongodb://localhost/')
+    db = client['in_situ_fluo']
+    stack_coll = db['stacks']
+    query = {'beamline': beamline}
+    if sample_name is not None:
+        query['sample_name'] = sample_name
+    if scan_type is not None:
+        query['scan_type'] = scan_type
+    try:
+        for doc in stack_coll.find(query):
+            print('Clustering ' + doc['beamline'] + " " + doc['sample_name'] + " " + doc['scan_type'])
+            try:
+                with h5py.File(doc['file_path'], 'r') as f:
+                    state = registration_state(f)
+                if state != 'materialised':
+                    print(f"Skipping {doc['file_path']}: " + ('registered without materialise=True' if state == 'transforms' else 'not registered'))
+                    continue
+                if sweep_config is not None:
+                    sweep(doc['file_path'], config['elements'], source=config.get('source', 'raw'), features=config.get('features'),
+                          **sweep_config)
+                KMeans(doc['file_path'], **config)
+                if ward_config is not None:
+                    Hierarchical(doc['file_path'], config['elements'], config['n_clusters'], source=config.get('source', 'raw'),
+                                 features=config.get('features'), **ward_config)
+            except Exception as e:
+                print(f'Clustering failed: {e!r}')
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    beamline = 'P06'
+    fname = os.path.splitext(__file__)[0]
+
+    config_path = f'{fname}.json'
+    clustering(beamline, config_path)
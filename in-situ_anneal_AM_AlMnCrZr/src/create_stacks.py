@@ -13,28 +13,23 @@ import h5py
 import os
 import numpy as np
 from typing import List, Dict, Tuple
+from logbook import load_lookup_table
+from stack_io import frame_extents, write_pyramids
+from mongo_sync import sync_fields, sync_documents, print_sync_counts
 def read_excel_lookup_table(excel_path: str) -> pd.DataFrame:
     """
     Reads the Excel lookup table and returns a DataFrame with scan numbers and types.
+    The parsed table is cached as Parquet next to the Excel file (see logbook.py), so the Excel
+    file is only parsed again when it has been modified.
     
     Args:
     - excel_path (str): Path to the Excel lookup table.
     
     Returns:
     - DataFrame: A DataFrame with the contents of the Excel lookup table,
-                 with columns for 'Scan Number' and 'Scan Types'.
+                 with columns for 'Scan Number' (int64) and 'Scan Types' (category).
     """
-    # Assuming the Excel file has a consistent structure with 'Scan Number' and 'Scan Type' columns
-    # across all sheets. Concatenates all sheets into a single DataFrame.
-    xl = pd.ExcelFile(excel_path)
-    df_list = []
-    for sheet_name in xl.sheet_names:
-        df = xl.parse(sheet_name)[['Scan Number', 'Scan Type']]  # Extract only the required columns
-        # Remove rows where 'Scan Type' is NaN
-        df = df.dropna(subset=['Scan Type'])
-
-        df_list.append(df)
-    return pd.concat(df_list, ignore_index=True)
+    return load_lookup_table(excel_path)
 def organize_scans_into_stacks(beamline : str, df: pd.DataFrame, base_folder: str, db: pymongo.database.Database, stacks : Dict) -> None:
     """
     Organizes scans into stacks by looking up the sample name from the database for each scan number,
@@ -81,7 +76,8 @@ def stacker(data_stack: List[np.ndarray]) -> np.ndarray:
     """
     Takes a list of 2D arrays in data_stack, and stacks them along the 0-axis.
     Handles the situation when not all 2D arrays are of the exact same shape by padding 
-    smaller 2D arrays with NaN values to match the largest array. 
+    smaller 2D arrays with NaN values to match the largest array. The valid extent of each
+    frame can be obtained with stack_io.frame_extents(data_stack).
 
     Args:
     - data_stack (List[np.ndarray]): List of 2D numpy arrays.
@@ -121,6 +117,9 @@ def create_hdf5_stack(beamline : str, scan_type: str, sample_name: str, scan_num
 
     Returns:
     - None
+
+    Raises:
+    - ValueError: if the elemental maps, pixel times and positions of the scans do not all have the same frame shapes
     """
     # Define the HDF5 file path
     hdf5_file_path = os.path.join(base_folder, sample_name, "stacks", f"{scan_type}.h5")
@@ -128,8 +127,20 @@ def create_hdf5_stack(beamline : str, scan_type: str, sample_name: str, scan_num
     # Create the base folder if it does not exist
     os.makedirs(os.path.dirname(hdf5_file_path), exist_ok=True)
 
+    # Keep the cached pairwise registration transforms (see stack_registration.TransformCache) of an existing stack,
+    # so that re-registering after adding scans only calculates the new pairs
+    registration_cache = None
+    if os.path.exists(hdf5_file_path):
+        with h5py.File(hdf5_file_path, 'r') as old_file:
+            if 'registration_cache' in old_file:
+                registration_cache = h5py.File(f'{scan_type}_registration_cache', 'w', driver='core', backing_store=False)
+                old_file.copy('registration_cache', registration_cache)
+
     # Open a new HDF5 file in write mode
     with h5py.File(hdf5_file_path, 'w') as hdf5_file:
+        if registration_cache is not None:
+            registration_cache.copy('registration_cache', hdf5_file)
+            registration_cache.close()
         # Create the 'unregistered' group
         hdf5_file.create_dataset('scan_numbers', data=scan_numbers, dtype=int)
         unregistered_group = hdf5_file.create_group('unregistered')
@@ -178,6 +189,20 @@ def create_hdf5_stack(beamline : str, scan_type: str, sample_name: str, scan_num
                     else:
                         element_stacks[element].append(element_data)
 
+        # Store the valid (rows, cols) extent of each frame, so that the NaN padding added by stacker
+        # can be cropped without scanning the data. The extents are used for all datasets, so their frames must have the same shapes
+        if element_stacks:
+            ref_element = next(iter(element_stacks))
+            extents = frame_extents(element_stacks[ref_element])
+            frame_stacks = {**element_stacks, 'unix_time': pixel_times_stack, 'positions_fast': positions_fast_stack,
+                            'positions_slow': positions_slow_stack}
+            for name, data_stack in frame_stacks.items():
+                if data_stack and not np.array_equal(frame_extents(data_stack), extents):
+                    raise ValueError(f'The frames of {name} differ in number or shape from those of {ref_element} in {hdf5_file_path}, '
+                                     f'{[d.shape for d in data_stack]} instead of {[tuple(e) for e in extents]}')
+            ds = unregistered_group.create_dataset('valid_extents', data=extents)
+            ds.attrs['columns'] = ['rows', 'cols']
+
         # Write the stacked data to the new HDF5 file and include units metadata
         for element, data_stack in element_stacks.items():
             try:
@@ -204,6 +229,9 @@ def create_hdf5_stack(beamline : str, scan_type: str, sample_name: str, scan_num
             ds = positions_group.create_dataset('positions_slow', data=stacked_positions_slow)
             ds.attrs['units'] = units['positions_slow']
 
+        # downsampled previews of all datasets
+        write_pyramids(hdf5_file, 'unregistered')
+
     print(f"Created HDF5 file for sample '{sample_name}' with scan type '{scan_type}' containing {len(scan_numbers)} scans.")
 
 
@@ -216,24 +244,19 @@ def update_mongodb_scans(beamline : str, df: pd.DataFrame, db: pymongo.database.
     - df (pd.DataFrame): DataFrame containing scan numbers and types.
     - db (pymongo.database.Database): The MongoDB database instance where documents are stored.
     
+    Only documents where the scan type changed are updated, in batched bulk writes.
     
     Returns:
     - None
     """
     # Retrieve the 'scans' collection
-    
     scans_collection = db['scans']
 
-    # Iterate through the DataFrame and update each scan with its type
-    for index, row in df.iterrows():
-        scan_number = row['Scan Number']
-        scan_type = row['Scan Type']
-        # Update the document where the scan number matches
-        scans_collection.update_one(
-            {'beamline' : beamline, 'scan_number': scan_number},
-            {'$set': {'scan_type': scan_type}},
-            upsert=False  # Assuming that the document already exists
-        )
+    # Desired scan type for each scan number. Only scans whose stored type differs are sent to the db
+    desired = {int(scan_number): {'scan_type': str(scan_type)}
+               for scan_number, scan_type in zip(df['Scan Number'], df['Scan Type'])}
+    counts = sync_fields(scans_collection, {'beamline': beamline}, 'scan_number', desired)
+    print_sync_counts('scans', counts)
 def create_mongodb_stacks_collection(base_folder : str, beamline : str, stacks: Dict[Tuple[str, str], List[int]], db: pymongo.database.Database) -> None:
     """
     Creates and populates a 'stacks' collection in MongoDB.
@@ -249,28 +272,22 @@ def create_mongodb_stacks_collection(base_folder : str, beamline : str, stacks:
     """
     
     stacks_collection = db['stacks']
-    
 
-    # Iterate through the stacks dictionary and create documents for the 'stacks' collection
+    # Build the desired document for each stack. Only stacks that differ from the stored ones are written
+    stack_documents = []
     for (sample_name, scan_type), scan_numbers in stacks.items():
-        # Create a query for the unique combination of beamline, sample_name, and scan_type
-        query = {
-            'beamline': beamline,
-            'sample_name': sample_name,
-            'scan_type': scan_type
-        }
         file_path = os.path.join(base_folder, sample_name, "stacks", f"{scan_type}.h5")
-    # Create a document for the stack
-        stack_document = {
+        stack_documents.append({
             'beamline': beamline,
             'sample_name': sample_name,
             'scan_type': scan_type,
-            'scan_numbers': scan_numbers,
+            'scan_numbers': [int(n) for n in scan_numbers],
             'file_path' : file_path
-        }
-        
-        # Replace the existing document or insert a new one if it doesn't exist
-        stacks_collection.replace_one(query, stack_document, upsert=True)
+        })
+
+    counts = sync_documents(stacks_collection, {'beamline': beamline},
+                            ('beamline', 'sample_name', 'scan_type'), stack_documents)
+    print_sync_counts('stacks', counts)
 
 
 def main(beamline : str, excel_path: str, base_folder: str, mongo_uri: str, db_name: str):
@@ -3,10 +3,14 @@
 #
 # by Isac Lazar
 #
+# dm3 files are found by their unique image number through a catalog of the session directory (see dm3_catalog).
+# The catalog is built once with os.scandir, saved as .dm3_catalog.json in the session directory and kept in memory,
+# and rebuilt when the modification time of any of its directories changes (files added, removed or renamed).
 import numpy as np
 import hyperspy.api as hs
-import glob
+import json
 import os
+import re
 def correct_pixel_scaling(s: hs.signals.Signal2D) -> None:
     '''If the image loaded into the signal is a diffraction pattern, change the 
     physical size spec of the pixels according to calibration'''
@@ -42,6 +46,123 @@ def load_dm3_image(fname: str) -> (np.array, dict):
     
     return im, md
 
+DM3_CATALOG_NAME = '.dm3_catalog.json'
+# image number: the last group of four or more digits in the file name, e.g. 0150 in 'BF 40kx 0150.dm3' or 10000 in 'BF 10000.dm3'
+IMAGE_NUMBER_PATTERN = re.compile(r'(\d{4,})')
+
+# catalogs already loaded in this process, keyed on root path
+_catalogs = {}
+
+
+def parse_image_number(fname: str) -> int:
+    '''Returns the image number in the name of a dm3 file, or None if there is none'''
+    matches = IMAGE_NUMBER_PATTERN.findall(os.path.splitext(os.path.basename(fname))[0])
+    return int(matches[-1]) if matches else None
+
+
+def scan_dm3_files(root_path: str) -> dict:
+    '''Walks the root path with os.scandir (skipping hidden files and directories, like glob) and returns a catalog
+    Returns:
+        dict: 'dirs': modification time (ns) of every directory, 'files': size and modification time of every dm3 file,
+            'images': image number -> dm3 files with that number, in numerical order. All paths are relative to the root path.
+            'pattern': IMAGE_NUMBER_PATTERN, catalogs saved with another pattern are rebuilt.
+        '''
+    catalog = {'dirs': {}, 'files': {}, 'images': {}, 'pattern': IMAGE_NUMBER_PATTERN.pattern}
+    dirs = [root_path]
+    while dirs:
+        d = dirs.pop()
+        catalog['dirs'][os.path.relpath(d, root_path)] = os.stat(d).st_mtime_ns
+        with os.scandir(d) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                elif entry.name.endswith('.dm3') and entry.is_file():
+                    path = os.path.relpath(entry.path, root_path)
+                    stat = entry.stat()
+                    catalog['files'][path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    images = {}
+    for path in sorted(catalog['files']):
+        im_nr = parse_image_number(path)
+        if im_nr is not None:
+            images.setdefault(str(im_nr), []).append(path)
+    # sorted as strings, 10000 would come before 9999
+    catalog['images'] = {im_nr: images[im_nr] for im_nr in sorted(images, key=int)}
+    return catalog
+
+
+def catalog_is_current(root_path: str, catalog: dict) -> bool:
+    '''True if none of the directories of the catalog have been modified since it was built, and it was built with IMAGE_NUMBER_PATTERN'''
+    if catalog.get('pattern') != IMAGE_NUMBER_PATTERN.pattern:
+        return False
+    try:
+        return all(os.stat(os.path.join(root_path, d)).st_mtime_ns == mtime for d, mtime in catalog['dirs'].items())
+    except OSError:
+        return False
+
+
+def dm3_catalog(root_path: str, refresh: bool = False) -> dict:
+    '''Returns the catalog of the dm3 files in the root path (see scan_dm3_files), from memory or .dm3_catalog.json
+    in the root path if it is current, otherwise scans the root path and saves the catalog (if the root path is writable)
+    Parameters:
+        str root_path: path to look for .dm3 files
+        bool refresh: rescan even if the catalog is current
+    Returns:
+        dict: the catalog
+        '''
+    root_path = os.path.abspath(root_path)
+    if not refresh:
+        if root_path in _catalogs:
+            return _catalogs[root_path]
+        try:
+            with open(os.path.join(root_path, DM3_CATALOG_NAME), 'r') as f:
+                catalog = json.load(f)
+            if catalog_is_current(root_path, catalog):
+                _catalogs[root_path] = catalog
+                return catalog
+        except (OSError, ValueError):
+            pass
+
+    print(f'Cataloguing dm3 files in {root_path}')
+    catalog = scan_dm3_files(root_path)
+    catalog_path = os.path.join(root_path, DM3_CATALOG_NAME)
+    try:
+        with open(catalog_path, 'w') as f:
+            json.dump(catalog, f)
+        # creating the catalog file modifies the root path; overwriting the now existing file does not
+        root_mtime = os.stat(root_path).st_mtime_ns
+        if catalog['dirs']['.'] != root_mtime:
+            catalog['dirs']['.'] = root_mtime
+            with open(catalog_path, 'w') as f:
+                json.dump(catalog, f)
+    except OSError as e:
+        print(f'Could not save dm3 catalog: {e}')
+    _catalogs[root_path] = catalog
+    return catalog
+
+
+def find_dm3_by_unique_number(root_path: str, im_nr: int) -> str:
+    '''Returns the path of the dm3 file with the unique image number in the root path
+    Parameters:
+        str root_path: path to look for .dm3 files
+        int im_nr: the unique image number
+    Returns:
+        str: path of the dm3 file
+        '''
+    root_path = os.path.abspath(root_path)
+    catalog = dm3_catalog(root_path)
+    # an image that is missing from a catalog held in memory may have been saved since, check once more
+    if str(im_nr) not in catalog['images'] and not catalog_is_current(root_path, catalog):
+        catalog = dm3_catalog(root_path, refresh=True)
+    paths = catalog['images'].get(str(im_nr))
+    if not paths:
+        raise FileNotFoundError(f'No dm3 file with image number {im_nr} in {root_path}')
+    if len(paths) > 1:
+        print(f'Image number {im_nr} is not unique, using {paths[0]} of {paths}')
+    return os.path.join(root_path, paths[0])
+
+
 def load_dm3_by_unique_number(root_path: str, im_nr: int) -> (np.array, dict):
     '''Loads the microscope image with the unique image number, present somewhere in the root path
     Parameters:
@@ -54,9 +175,7 @@ def load_dm3_by_unique_number(root_path: str, im_nr: int) -> (np.array, dict):
         
         '''
         
-    files = glob.glob(os.path.join(root_path, '**/*.dm3'), recursive=True)
-    frame_nr = str(im_nr).zfill(4)
-    frame_fn = [s for s in files if frame_nr in s][0]
+    frame_fn = find_dm3_by_unique_number(root_path, im_nr)
     
     im, md = load_dm3_image(frame_fn)
     
@@ -0,0 +1,119 @@
+#
+# Cached access to the Excel logbook lookup table (scan number -> scan type).
+#
+# Parsing the logbook with openpyxl is slow, so the parsed table is cached as a Parquet file next to the Excel file.
+# The cache is keyed on the modification time and size of the Excel file, and is rebuilt automatically when either changes.
+# Scan numbers are stored as int64 and scan types as a categorical.
+# load_lookup_table()
+# get_scan_type()
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Dict, Optional
+
+DEFAULT_EXCEL_PATH = "/data/lazari/data/chalmers_al_am/Al_AM_P06/logbook_look_up_table.xlsx"
+CACHE_KEY_MTIME = b'excel_mtime_ns'
+CACHE_KEY_SIZE = b'excel_size'
+
+# Lookup tables already loaded in this process, keyed on (cache path, mtime, size)
+_loaded_tables: Dict[tuple, pd.DataFrame] = {}
+
+
+def default_cache_path(excel_path: str) -> str:
+    return os.path.splitext(excel_path)[0] + '.parquet'
+
+
+def _excel_key(excel_path: str) -> Dict[bytes, bytes]:
+    stat = os.stat(excel_path)
+    return {CACHE_KEY_MTIME: str(stat.st_mtime_ns).encode(), CACHE_KEY_SIZE: str(stat.st_size).encode()}
+
+
+def parse_excel_lookup_table(excel_path: str) -> pd.DataFrame:
+    """
+    Parses all sheets of the Excel lookup table into a single DataFrame with enforced dtypes.
+
+    Args:
+    - excel_path (str): Path to the Excel lookup table.
+
+    Returns:
+    - DataFrame: Columns 'Scan Number' (int64) and 'Scan Type' (category).
+    """
+    # Assuming the Excel file has a consistent structure with 'Scan Number' and 'Scan Type' columns
+    # across all sheets. Concatenates all sheets into a single DataFrame.
+    sheets = pd.read_excel(excel_path, sheet_name=None, usecols=['Scan Number', 'Scan Type'])
+    df = pd.concat(sheets.values(), ignore_index=True)
+    # Remove rows without a scan type or scan number
+    df = df.dropna(subset=['Scan Number', 'Scan Type'])
+    df['Scan Number'] = df['Scan Number'].astype('int64')
+    df['Scan Type'] = df['Scan Type'].astype(str).astype('category')
+    return df.reset_index(drop=True)
+
+
+def load_lookup_table(excel_path: str = DEFAULT_EXCEL_PATH, cache_path: Optional[str] = None, refresh: bool = False) -> pd.DataFrame:
+    """
+    Loads the lookup table from the Parquet cache if it is up to date with the Excel file,
+    otherwise parses the Excel file and rewrites the cache.
+
+    Args:
+    - excel_path (str): Path to the Excel lookup table.
+    - cache_path (str, optional): Path of the Parquet cache. Defaults to the Excel path with a .parquet extension.
+    - refresh (bool): Force parsing of the Excel file. Default False.
+
+    Returns:
+    - DataFrame: Columns 'Scan Number' (int64) and 'Scan Type' (category).
+    """
+    if cache_path is None:
+        cache_path = default_cache_path(excel_path)
+    key = _excel_key(excel_path)
+    memory_key = (cache_path, key[CACHE_KEY_MTIME], key[CACHE_KEY_SIZE])
+    if not refresh:
+        if memory_key in _loaded_tables:
+            return _loaded_tables[memory_key]
+        if os.path.exists(cache_path):
+            metadata = pq.read_schema(cache_path).metadata or {}
+            if all(metadata.get(k) == v for k, v in key.items()):
+                df = pd.read_parquet(cache_path)
+                _loaded_tables[memory_key] = df
+                return df
+
+    print(f'Parsing {excel_path}')
+    df = parse_excel_lookup_table(excel_path)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **key})
+    pq.write_table(table, cache_path)
+    _loaded_tables[memory_key] = df
+    return df
+
+
+def get_scan_type(scan_number: int, excel_path: str = DEFAULT_EXCEL_PATH) -> Optional[str]:
+    """
+    Returns the scan type of a scan number according to the logbook, or None if the scan is not in the logbook.
+
+    Args:
+    - scan_number (int): The scan number to look up.
+    - excel_path (str): Path to the Excel lookup table.
+
+    Returns:
+    - str: The scan type, e.g. 'jmesh ROI2'.
+    """
+    df = load_lookup_table(excel_path)
+    matches = df.loc[df['Scan Number'] == scan_number, 'Scan Type']
+    if matches.empty:
+        return None
+    return str(matches.iloc[0])
+
+
+def get_scan_numbers(scan_type: str, excel_path: str = DEFAULT_EXCEL_PATH) -> list:
+    """
+    Returns the scan numbers that have the given scan type according to the logbook, in ascending order.
+
+    Args:
+    - scan_type (str): The scan type, e.g. 'jmesh ROI2'.
+    - excel_path (str): Path to the Excel lookup table.
+
+    Returns:
+    - list: Sorted list of scan numbers.
+    """
+    df = load_lookup_table(excel_path)
+    return sorted(int(n) for n in df.loc[df['Scan Type'] == scan_type, 'Scan Number'])
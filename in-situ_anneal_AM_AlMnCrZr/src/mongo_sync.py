@@ -0,0 +1,121 @@
+#
+# Batched synchronisation of MongoDB collections.
+#
+# Instead of sending one update_one/replace_one per document, the desired state of a set of documents is
+# compared against the current state in the database (fetched with a single find), and only the documents
+# that actually changed are sent in ordered bulk_write batches.
+# sync_fields()
+# sync_documents()
+import pymongo
+from typing import Dict, List, Tuple, Any
+
+
+def _chunks(ops: List, batch_size: int):
+    for i in range(0, len(ops), batch_size):
+        yield ops[i:i + batch_size]
+
+
+def _write_batches(collection: pymongo.collection.Collection, ops: List, batch_size: int) -> Dict[str, int]:
+    """
+    Sends the operations to the collection in ordered bulk_write batches.
+
+    Args:
+    - collection (pymongo.collection.Collection): The collection to write to.
+    - ops (List): List of pymongo write operations (UpdateOne, ReplaceOne etc.)
+    - batch_size (int): Maximum number of operations per bulk_write call.
+
+    Returns:
+    - dict: Counts of batches, modified and upserted documents.
+    """
+    counts = {'batches': 0, 'modified': 0, 'upserted': 0}
+    for batch in _chunks(ops, batch_size):
+        result = collection.bulk_write(batch, ordered=True)
+        counts['batches'] += 1
+        counts['modified'] += result.modified_count
+        counts['upserted'] += result.upserted_count
+    return counts
+
+
+def sync_fields(collection: pymongo.collection.Collection, base_query: Dict, key_field: str,
+                desired: Dict[Any, Dict[str, Any]], batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Sets fields on existing documents, only sending updates for documents where the value differs.
+    Documents are identified by base_query combined with key_field, e.g. {'beamline': 'P06'} and 'scan_number'.
+    Documents that do not exist in the collection are not created.
+
+    Args:
+    - collection (pymongo.collection.Collection): The collection to update.
+    - base_query (dict): Query shared by all documents, e.g. {'beamline': 'P06'}.
+    - key_field (str): Field that identifies a document within base_query, e.g. 'scan_number'.
+    - desired (Dict[Any, Dict[str, Any]]): Maps key_field values to the fields that should be set.
+    - batch_size (int): Maximum number of operations per bulk_write call. Default 1000.
+
+    Returns:
+    - dict: Counts of 'desired', 'unchanged', 'missing', 'changed', 'batches', 'modified' and 'upserted' documents.
+    """
+    fields = sorted({field for values in desired.values() for field in values})
+    projection = {key_field: 1, '_id': 0}
+    projection.update({field: 1 for field in fields})
+    query = dict(base_query)
+    query[key_field] = {'$in': list(desired.keys())}
+    current = {doc[key_field]: doc for doc in collection.find(query, projection)}
+
+    ops = []
+    counts = {'desired': len(desired), 'unchanged': 0, 'missing': 0}
+    for key, values in desired.items():
+        if key not in current:
+            counts['missing'] += 1
+            continue
+        changed = {field: value for field, value in values.items() if current[key].get(field) != value}
+        if not changed:
+            counts['unchanged'] += 1
+            continue
+        doc_query = dict(base_query)
+        doc_query[key_field] = key
+        ops.append(pymongo.UpdateOne(doc_query, {'$set': changed}, upsert=False))
+    counts['changed'] = len(ops)
+    counts.update(_write_batches(collection, ops, batch_size))
+    return counts
+
+
+def sync_documents(collection: pymongo.collection.Collection, base_query: Dict, key_fields: Tuple[str, ...],
+                   desired: List[Dict[str, Any]], batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Makes the documents matching base_query look like the desired documents, replacing (or inserting)
+    only those that differ from what is stored. Documents in the collection that are not in desired are left untouched.
+
+    Args:
+    - collection (pymongo.collection.Collection): The collection to update.
+    - base_query (dict): Query shared by all documents, e.g. {'beamline': 'P06'}.
+    - key_fields (Tuple[str, ...]): Fields that together identify a document, e.g. ('beamline', 'sample_name', 'scan_type').
+    - desired (List[dict]): The full documents (without '_id') as they should be stored.
+    - batch_size (int): Maximum number of operations per bulk_write call. Default 1000.
+
+    Returns:
+    - dict: Counts of 'desired', 'unchanged', 'new', 'changed', 'batches', 'modified' and 'upserted' documents.
+    """
+    current = {}
+    for doc in collection.find(base_query):
+        doc.pop('_id', None)
+        current[tuple(doc.get(field) for field in key_fields)] = doc
+
+    ops = []
+    counts = {'desired': len(desired), 'unchanged': 0, 'new': 0}
+    for doc in desired:
+        key = tuple(doc[field] for field in key_fields)
+        if key not in current:
+            counts['new'] += 1
+        elif current[key] == doc:
+            counts['unchanged'] += 1
+            continue
+        query = {field: doc[field] for field in key_fields}
+        ops.append(pymongo.ReplaceOne(query, doc, upsert=True))
+    counts['changed'] = len(ops)
+    counts.update(_write_batches(collection, ops, batch_size))
+    return counts
+
+
+def print_sync_counts(name: str, counts: Dict[str, int]) -> None:
+    print(f"{name}: {counts['desired']} desired, {counts['unchanged']} unchanged, {counts['changed']} changed "
+          f"({counts['modified']} modified, {counts['upserted']} inserted) in {counts['batches']} bulk writes"
+          + (f", {counts['missing']} missing" if 'missing' in counts else ''))
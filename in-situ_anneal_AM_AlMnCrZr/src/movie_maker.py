@@ -4,11 +4,20 @@
 # by Isac Lazar
 #
 # This script takes in stacks of images, and produces movies of them. Given a json config, it can also create an rgb movie based on 3 elements
+# Frames are converted to uint8 with numpy, optionally upscaled and labelled with a scale bar and timestamp (PIL),
+# and piped as raw RGB frames directly into an ffmpeg process (FFmpegWriter), without rendering them with matplotlib.
+# Stacks are read one frame at a time (rgb_frames), so memory use does not grow with the length of the series.
+# The normalisation constant of each element (nanmax or a percentile) is calculated once and cached as an attribute of its dataset.
+# batch_movie_maker() renders every (stack, element combination) of a JSON config (movie_maker.json) in a process pool,
+# skipping movies that are newer than the registration of their stack (see stack_io.registration_stamp).
+# Stacks registered without materialising the registered datasets are read through registered_stack.RegisteredStack,
+# which warps the frames as they are rendered.
 # movie_maker()
+# batch_movie_maker()
+# encode_movie()
 # create_rgb() #maybe this one should be in figures/figuretools ?
 
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image
 from glob import glob
 import pandas as pd
@@ -16,13 +25,353 @@ import os
 from natsort import natsorted
 from ipywidgets import interact
 import pymongo
-import matplotlib.animation as animation
 from pathlib import Path
 import h5py
-def movie_maker(beamline : str = None, sample_name : str = None, scan_type : str = None):
-    client = pymongo.MongoClient('mongodb://localhost/')
-    db = client['in_situ_fluo']
-    stack_coll = db['stacks']
+import subprocess
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import ImageDraw, ImageFont
+from typing import Iterable, List
+from stack_io import registration_stamp, registration_state
+from registered_stack import RegisteredStack
+
+
+def rgb_to_uint8(rgb : np.ndarray) -> np.ndarray:
+    """Converts a float RGB frame with values in [0, 1] to uint8. NaN values become black"""
+    out = np.nan_to_num(rgb, nan=0.0)
+    np.clip(out, 0, 1, out=out)
+    out *= 255
+    np.rint(out, out=out)
+    return out.astype(np.uint8)
+
+
+def upscale(frame : np.ndarray, factor : int) -> np.ndarray:
+    """Integer upscaling by repeating every pixel factor x factor times (nearest neighbour, no smoothing of the maps)"""
+    if factor == 1:
+        return frame
+    return np.repeat(np.repeat(frame, factor, axis=0), factor, axis=1)
+
+
+def pad_even(frame : np.ndarray) -> np.ndarray:
+    """Pads a frame with black pixels at the bottom and right to even dimensions, which yuv420p video requires"""
+    pad_rows, pad_cols = frame.shape[0] % 2, frame.shape[1] % 2
+    if not (pad_rows or pad_cols):
+        return frame
+    return np.pad(frame, ((0, pad_rows), (0, pad_cols), (0, 0)))
+
+
+def nice_length(length : float) -> float:
+    """Rounds down to 1, 2 or 5 times a power of 10, for scale bars"""
+    power = 10**np.floor(np.log10(length))
+    for factor in [5, 2, 1]:
+        if factor*power <= length:
+            return factor*power
+    return power
+
+
+def burn_in(frame : np.ndarray, text : str = None, scale_bar_px : int = None, scale_bar_label : str = None) -> np.ndarray:
+    """
+    Draws a text (e.g. a timestamp) in the top left corner and a scale bar in the bottom right corner of a uint8 RGB frame.
+
+    Args:
+    - frame (np.ndarray) : (rows, cols, 3) uint8 frame
+    - text (str) : optional text in the top left corner
+    - scale_bar_px (int) : optional length of the scale bar in pixels of the frame
+    - scale_bar_label (str) : label above the scale bar, e.g. '5 um'
+    """
+    if text is None and scale_bar_px is None:
+        return frame
+    im = Image.fromarray(frame)
+    draw = ImageDraw.Draw(im)
+    font_size = max(10, frame.shape[0]//25)
+    font = ImageFont.load_default(size=font_size)
+    margin = font_size//2
+    if text is not None:
+        draw.text((margin, margin), text, fill=(255, 255, 255), font=font, stroke_width=max(1, font_size//10), stroke_fill=(0, 0, 0))
+    if scale_bar_px is not None:
+        bar_height = max(2, font_size//4)
+        x1, y1 = frame.shape[1] - margin, frame.shape[0] - margin
+        x0, y0 = x1 - scale_bar_px, y1 - bar_height
+        draw.rectangle((x0, y0, x1, y1), fill=(255, 255, 255), outline=(0, 0, 0))
+        if scale_bar_label is not None:
+            draw.text(((x0 + x1)/2, y0 - margin//2), scale_bar_label, fill=(255, 255, 255), font=font, anchor='mb',
+                      stroke_width=max(1, font_size//10), stroke_fill=(0, 0, 0))
+    return np.asarray(im)
+
+
+class FFmpegWriter:
+    """
+    Writes uint8 RGB frames to a video file by piping them as raw video into an ffmpeg process.
+    The frame size is taken from the first frame, all frames must have the same (even) size.
+
+    Parameters:
+        save_path (str): Path of the video file.
+        fps (float): Frames per second.
+        ffmpeg (str, optional): ffmpeg executable. Defaults to 'ffmpeg'.
+        crf (int, optional): Constant rate factor of libx264, lower is better quality. Defaults to 18.
+    """
+    def __init__(self, save_path : str, fps : float, ffmpeg : str = 'ffmpeg', crf : int = 18):
+        self.save_path = save_path
+        self.fps = fps
+        self.ffmpeg = ffmpeg
+        self.crf = crf
+        self.process = None
+        self.shape = None
+        self.n_frames = 0
+
+    def _start(self, shape : tuple) -> None:
+        self.shape = shape
+        cmd = [self.ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{shape[1]}x{shape[0]}', '-r', str(self.fps), '-i', '-',
+               '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', str(self.crf), self.save_path]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def write(self, frame : np.ndarray) -> None:
+        if self.process is None:
+            self._start(frame.shape)
+        if frame.shape != self.shape:
+            raise ValueError(f'Frame shape {frame.shape} differs from the first frame {self.shape}')
+        self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        self.n_frames += 1
+
+    def close(self) -> None:
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        stderr = self.process.stderr.read()
+        if self.process.wait() != 0:
+            raise RuntimeError(f'ffmpeg failed on {self.save_path}: {stderr.decode(errors="replace")}')
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def pixel_size_from_stack(f : h5py.File, group : str = 'registered') -> (float, str):
+    """Pixel size and its units from the fast positions of the first frame, or (None, None) if there are no positions"""
+    path = f'/{group}/positions/positions_fast'
+    if path not in f:
+        return None, None
+    step = np.nanmedian(np.abs(np.diff(f[path][0], axis=1)))
+    if not np.isfinite(step) or step == 0:
+        return None, None
+    return float(step), f[path].attrs.get('units', '')
+
+
+def frame_times_from_stack(f : h5py.File, group : str = 'registered') -> np.ndarray:
+    """Start time of every frame in seconds after the start of the first frame, or None if there is no unix_time"""
+    path = f'/{group}/unix_time'
+    if path not in f:
+        return None
+    return frame_times(f[path])
+
+
+def frame_times(ds : h5py.Dataset) -> np.ndarray:
+    """Start time of every frame of a unix_time stack in seconds after the start of the first frame, read one frame at a time"""
+    # fmin ignores NaN like nanmin, but gives NaN for frames that are all NaN (skipped in the registration) without a warning
+    starts = np.array([np.fmin.reduce(ds[i].ravel()) for i in range(ds.shape[0])])
+    return starts - starts[0]
+
+
+def normalisation_key(method : str = 'nanmax', percentile : float = 99.5) -> str:
+    """Name of the dataset attribute that caches a normalisation constant, see normalisation_constant"""
+    if method == 'nanmax':
+        return 'norm_nanmax'
+    elif method == 'percentile':
+        return f'norm_p{percentile:g}'
+    raise ValueError(f'Unknown normalisation {method}')
+
+
+def normalisation_constant(ds : h5py.Dataset, method : str = 'nanmax', percentile : float = 99.5, samples_per_frame : int = 10000, seed : int = 0) -> float:
+    """
+    Value that a stack is divided by to scale it to [0, 1], calculated one frame at a time and cached as an attribute of the dataset
+    (norm_nanmax or norm_p<percentile>) if the file is writable. The attributes disappear when the dataset is rewritten, e.g. by a new registration.
+    Views of stacks that were not materialised (registered_stack.RegisteredDataset) have no attributes, their constant is not cached.
+
+    Args:
+    - ds (h5py.Dataset) : (frames, rows, cols) stack, or a RegisteredDataset
+    - method (str) : 'nanmax' or 'percentile'. Default 'nanmax'
+    - percentile (float) : percentile of all non-NaN values for method 'percentile', robust to hot pixels. Default 99.5
+    - samples_per_frame (int) : for method 'percentile', at most this many random pixels of each frame are used, to bound the memory. Default 10000
+    - seed (int) : seed of the pixel sample. Default 0
+    """
+    key = normalisation_key(method, percentile)
+    cached = isinstance(ds, h5py.Dataset)
+    if cached and key in ds.attrs:
+        return float(ds.attrs[key])
+
+    if method == 'nanmax':
+        value = np.fmax.reduce([np.fmax.reduce(ds[i].ravel()) for i in range(ds.shape[0])])
+    else:
+        rng = np.random.default_rng(seed)
+        samples = []
+        for i in range(ds.shape[0]):
+            frame = ds[i].ravel()
+            frame = frame[~np.isnan(frame)]
+            samples.append(frame if len(frame) <= samples_per_frame else rng.choice(frame, samples_per_frame, replace=False))
+        value = np.percentile(np.concatenate(samples), percentile)
+    value = float(value)
+    if cached and ds.file.mode == 'r+':
+        ds.attrs[key] = value
+    return value
+
+
+def rgb_frames(datasets : List[h5py.Dataset], constants : List[float], colours : List[List[float]] = None) -> Iterable[np.ndarray]:
+    """
+    Yields the RGB frames of stacks one at a time. Stack i is divided by constants[i] and added with the RGB colour colours[i].
+    By default stack i goes in colour channel i (red, green, blue), so at most three stacks.
+    Only one frame of each stack is read and in memory at a time.
+    """
+    if colours is None:
+        if len(datasets) > 3:
+            raise ValueError(f'{len(datasets)} stacks need colours, only three can go in the red, green and blue channels by default')
+        colours = np.eye(3)[:len(datasets)]
+    n_frames, rows, cols = datasets[0].shape
+    colours = np.asarray(colours, dtype=np.float32)
+    for i in range(n_frames):
+        rgb = np.zeros((rows, cols, 3), dtype=np.float32)
+        for ds, constant, colour in zip(datasets, constants, colours):
+            rgb += (ds[i]/constant).astype(np.float32)[..., None]*colour
+        yield rgb
+
+
+def encode_movie(frames : Iterable[np.ndarray], save_path : str, fps : float, scale : int = 1, times : np.ndarray = None,
+                 pixel_size : float = None, pixel_units : str = 'um', ffmpeg : str = 'ffmpeg') -> int:
+    """
+    Encodes float RGB frames with values in [0, 1] into a video with ffmpeg.
+
+    Args:
+    - frames (Iterable[np.ndarray]) : (rows, cols, 3) float frames, e.g. a generator so that only one frame is in memory
+    - save_path (str) : path of the video file
+    - fps (float) : frames per second
+    - scale (int) : integer upscaling factor. Default 1
+    - times (np.ndarray) : optional time of every frame in seconds, burned in as a timestamp
+    - pixel_size (float) : optional size of a (not upscaled) pixel, for a scale bar of about a fifth of the frame width
+    - pixel_units (str) : units of pixel_size. Default 'um'
+    - ffmpeg (str) : ffmpeg executable. Default 'ffmpeg'
+
+    Returns:
+    - int : number of frames written
+    """
+    with FFmpegWriter(save_path, fps, ffmpeg) as writer:
+        for i, frame in enumerate(frames):
+            frame = upscale(rgb_to_uint8(frame), scale)
+            text = f't = {times[i]/60:.1f} min' if times is not None and np.isfinite(times[i]) else None
+            bar_px, bar_label = None, None
+            if pixel_size is not None:
+                bar_length = nice_length(frame.shape[1]/scale*pixel_size/5)
+                bar_px = int(round(bar_length/pixel_size*scale))
+                bar_label = f'{bar_length:g} {pixel_units}'
+            writer.write(pad_even(burn_in(frame, text, bar_px, bar_label)))
+    return writer.n_frames
+
+
+def movie_path(doc : dict, elements : List[str], output_dir : str = None) -> str:
+    """Path of the movie of a stack document and a combination of elements, in out/movies/<beamline>/<sample_name> by default"""
+    if output_dir is None:
+        output_dir = os.path.join(Path(__file__).parent.parent, 'out', 'movies')
+    fn = doc['scan_type'] + '_rgb_' + '_'.join(elements) + '.mp4'
+    return os.path.join(output_dir, doc['beamline'], doc['sample_name'], fn)
+
+
+def is_up_to_date(save_path : str, stamp : float) -> bool:
+    """True if the movie exists and is newer than stamp, the unix time the registered stack was written (see stack_io.registration_stamp)"""
+    return os.path.exists(save_path) and os.path.getmtime(save_path) > stamp
+
+
+def movie_jobs(stack_docs : Iterable[dict], movies : List[dict], normalisation : str = 'nanmax', scale : int = 4, fps : float = None,
+               output_dir : str = None, overwrite : bool = False) -> List[dict]:
+    """
+    Lists the movies to render, one job per stack and element combination.
+    Normalisation constants are calculated (and cached in the stack files) here, one stack at a time,
+    so the jobs only have to read the stack files and can run in parallel.
+
+    Args:
+    - stack_docs (Iterable[dict]) : documents of the stacks collection
+    - movies (List[dict]) : element combinations, each with 'elements' and optionally 'colours' (one RGB colour per element, see rgb_frames)
+    - normalisation (str) : see normalisation_constant. Default 'nanmax'
+    - scale (int) : integer upscaling. Default 4
+    - fps (float) : frames per second. Default 2 for more than 10 frames, otherwise 1
+    - output_dir (str) : see movie_path
+    - overwrite (bool) : also render movies that are newer than the registration of their stack. Default False
+
+    Stack files are opened read-only, and only reopened in r+ mode if a normalisation constant is not cached yet.
+    Stacks registered without materialising the registered datasets are read with registered_stack.RegisteredStack,
+    stacks that are not registered are skipped.
+    """
+    jobs = []
+    key = normalisation_key(normalisation)
+    for doc in stack_docs:
+        with h5py.File(doc['file_path'], 'r') as f:
+            state = registration_state(f)
+            if state is None:
+                print(f"Skipping {doc['file_path']}: not registered, run stack_registration.register_stacks first")
+                continue
+            stamp = registration_stamp(f)
+            if stamp is None:
+                # registered before the stamp existed
+                stamp = os.path.getmtime(doc['file_path'])
+            todo = [movie for movie in movies if overwrite or not is_up_to_date(movie_path(doc, movie['elements'], output_dir), stamp)]
+            # the constants of stacks that were not materialised are not cached, see normalisation_constant
+            missing = state == 'materialised' and any(key not in f['/registered/line_intensities'][element].attrs
+                                                      for movie in todo for element in movie['elements'])
+        if not todo:
+            continue
+        materialised = state == 'materialised'
+        with (h5py.File(doc['file_path'], 'r+' if missing else 'r') if materialised else RegisteredStack(doc['file_path'])) as f:
+            stack_group = f['/registered/line_intensities'] if materialised else f
+            n_frames = stack_group[todo[0]['elements'][0]].shape[0]
+            for movie in todo:
+                constants = [normalisation_constant(stack_group[element], normalisation) for element in movie['elements']] #normalise to 1
+                jobs.append({'file_path': doc['file_path'], 'materialised': materialised, 'name': doc['beamline'] + " " + doc['sample_name'] + " " + doc['scan_type'],
+                             'elements': movie['elements'], 'colours': movie.get('colours'), 'constants': constants,
+                             'save_path': movie_path(doc, movie['elements'], output_dir), 'scale': scale,
+                             'fps': fps if fps is not None else (2 if n_frames > 10 else 1)})
+    return jobs
+
+
+def render_movie(job : dict) -> dict:
+    """Renders one job of movie_jobs. Returns the job with the number of frames, time and error"""
+    t0 = time.time()
+    result = {'name': job['name'], 'save_path': job['save_path'], 'frames': 0, 'error': None}
+    try:
+        os.makedirs(os.path.dirname(job['save_path']), exist_ok=True)
+        with (h5py.File(job['file_path'], 'r') if job['materialised'] else RegisteredStack(job['file_path'])) as f:
+            if job['materialised']:
+                stack_group = f['/registered/line_intensities']
+                times = frame_times_from_stack(f)
+                pixel_size, pixel_units = pixel_size_from_stack(f)
+            else:
+                stack_group = f
+                times = frame_times(f['unix_time']) if 'unix_time' in f else None
+                # the registration does not scale the frames, so the pixel size of the unregistered positions is the same
+                pixel_size, pixel_units = pixel_size_from_stack(f.file, 'unregistered')
+            datasets = [stack_group[element] for element in job['elements']]
+            result['frames'] = encode_movie(rgb_frames(datasets, job['constants'], job['colours']), job['save_path'], job['fps'],
+                                            scale=job['scale'], times=times, pixel_size=pixel_size, pixel_units=pixel_units)
+    except Exception as e:
+        result['error'] = repr(e)
+    result['time_s'] = time.time() - t0
+    return result
+
+
+def print_movie_summary(results : List[dict]) -> None:
+    for result in results:
+        if result['error'] is not None:
+            print(f"FAILED {result['name']} {os.path.basename(result['save_path'])}: {result['error']}")
+        else:
+            print(f"{result['name']} {os.path.basename(result['save_path'])}: {result['frames']} frames in {result['time_s']:.1f} s "
+                  f"({result['frames']/max(result['time_s'], 1e-9):.1f} fps)")
+    n_failed = sum(result['error'] is not None for result in results)
+    print(f'Rendered {len(results) - n_failed} movies, {n_failed} failed')
+
+
+def _stack_query(beamline : str = None, sample_name : str = None, scan_type : str = None) -> dict:
     query = {}
     if beamline is not None:
         query['beamline'] = beamline
@@ -30,61 +379,74 @@ def movie_maker(beamline : str = None, sample_name : str = None, scan_type : str
         query['sample_name'] = sample_name
     if scan_type is not None:
         query['scan_type'] = scan_type
+    return query
+
+
+def batch_movie_maker(beamline : str, config_path : str, sample_name : str = None, scan_type : str = None, overwrite : bool = False) -> List[dict]:
+    """
+    Renders the movies of all stacks matching the query for all element combinations in the JSON config, in a process pool.
+    The config of the beamline has the keys:
+    - movies : list of {'elements': [...], 'colours': [[r, g, b], ...]} (colours optional, see rgb_frames)
+    - optional: n_workers (default 4), scale, normalisation, fps and output_dir, see movie_jobs
+    Movies that are newer than the registration of their stack (stack_io.registration_stamp, or the modification time of
+    the stack file for stacks registered before the stamp existed) are skipped unless overwrite is True.
+    """
+    with open(config_path, 'r') as f:
+        config = json.load(f)[beamline]
+    print(config)
+    client = pymongo.MongoClient('mongodb://localhost/')
+    db = client['in_situ_fluo']
+    stack_coll = db['stacks']
+    try:
+        stack_docs = list(stack_coll.find(_stack_query(beamline, sample_name, scan_type)))
+    finally:
+        client.close()
+
+    t0 = time.time()
+    jobs = movie_jobs(stack_docs, config['movies'], config.get('normalisation', 'nanmax'), config.get('scale', 4), config.get('fps'),
+                      config.get('output_dir'), overwrite)
+    n_total = len(stack_docs)*len(config['movies'])
+    print(f'{len(jobs)} of {n_total} movies to render, {n_total - len(jobs)} up to date or not registered')
+    results = []
+    if jobs:
+        n_workers = max(1, min(config.get('n_workers', 4), len(jobs)))
+        # every job runs its own ffmpeg process, so the number of workers bounds the number of encoders
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+            results = list(executor.map(render_movie, jobs))
+    print_movie_summary(results)
+    print(f'Total {time.time() - t0:.1f} s')
+    return results
+
+
+def movie_maker(beamline : str = None, sample_name : str = None, scan_type : str = None, scale : int = 4, normalisation : str = 'nanmax'):
+    client = pymongo.MongoClient('mongodb://localhost/')
+    db = client['in_situ_fluo']
+    stack_coll = db['stacks']
+    query = _stack_query(beamline, sample_name, scan_type)
         
-    stack_docs = stack_coll.find(query)
+    stack_docs = list(stack_coll.find(query))
+    client.close()
     element_names = ['Mn_Ka', 'Cr_Ka']
     
-    
+    results = []
     for doc in stack_docs:
+        print('Producing movie of ' + doc['beamline'] + " " + doc['sample_name'] + " " + doc['scan_type'])
         try:
-            print('Producing movie of ' + doc['beamline'] + " " + doc['sample_name'] + " " + doc['scan_type'])
-            with h5py.File(doc['file_path'], 'r') as f:
-                
-                stack_group = f[f'/registered/line_intensities']
-                elements_stacks = {}
-                for element in element_names:
-                    ims = stack_group[element][()]
-                    ims = ims/np.nanmax(ims) #normalise to 1
-                    elements_stacks[element] =  ims
-                    stack_shape = stack_group[element][()].shape
-                    dtype = stack_group[element][()].dtype
-                images_layered = np.zeros(shape=stack_shape[:] + (3,), dtype=dtype)
-                for idx, element in enumerate(element_names):
-                    images_layered[:,:,:, idx] = elements_stacks[element]
-            
-            dir = Path(__file__).parent.parent
-            folder_save_path = os.path.join(dir, 'out', 'movies', doc['beamline'], doc['sample_name'])
-            if not os.path.exists(folder_save_path):
-                os.makedirs(folder_save_path)
-            fn = doc['scan_type'] + '_rgb_' + '_'.join(element_names) + '.mp4'
-            save_path = os.path.join(folder_save_path, fn)
-
-
-            fig, ax = plt.subplots()
-
-            def animate(im_nr):
-    
-                plt.imshow(images_layered[im_nr,:, :, :], origin='upper')
-    
-    
-                
-                plt.axis('off')
-
-                # Create an animation object from a plotting variable
-            ani = animation.FuncAnimation(fig, animate, frames=range(0, images_layered.shape[0]), interval=1)
-
-            if images_layered.shape[0] > 10 :
-                fps = 2
-            else:
-                fps = 1
-            ani.save(save_path, writer='ffmpeg', fps=fps, dpi=600)
+            jobs = movie_jobs([doc], [{'elements': element_names}], normalisation, scale, overwrite=True)
         except Exception as e:
             print(e)
-                    
+            continue
+        results += [render_movie(job) for job in jobs]
+    print_movie_summary(results)
                     
                 
                 
 
 
 if __name__ == '__main__':
-    movie_maker()
\ No newline at end of file
+    beamline = 'P06'
+    fname = os.path.splitext(__file__)[0]
+
+    config_path = f'{fname}.json'
+    batch_movie_maker(beamline, config_path)
@@ -0,0 +1,193 @@
+#
+# Per-pixel time series features of registered stacks, used to reduce the dimension of the data before clustering.
+#
+# For every element and every pixel, a few summaries of the time series are calculated (ignoring NaN values):
+#   onset   : time at which the intensity has gone halfway from its initial to its final level
+#   slope   : least squares slope of the intensity over time
+#   ratio   : final level / initial level
+#   plateau : mean level after the onset
+# Times come from /registered/unix_time (the time each pixel was measured) if present, otherwise the frame index is used.
+# In addition, the normalised time series of all elements together are projected on their first principal components,
+# found with randomised PCA on a sample of pixels.
+# Features are calculated streaming blocks of rows, and cached in the stack file under /features as (features, rows, cols)
+# datasets, so they can be clustered like the registered stacks (see clustering.py).
+# The cache is recalculated when the parameters or the registration transforms change.
+# compute_features()
+# load_features()
+import json
+import time
+import hashlib
+import h5py
+import numpy as np
+from sklearn.decomposition import PCA
+from typing import List, Optional
+from stack_io import iter_pixel_blocks, read_pixel_block, pixel_statistics, normalise_block
+
+SUMMARY_FEATURES = ['onset', 'slope', 'ratio', 'plateau']
+
+
+def _masked_mean(Y: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    count = valid.sum(axis=1)
+    total = np.where(valid, Y, 0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total/count, np.nan)
+
+
+def time_series_summaries(Y: np.ndarray, T: np.ndarray, edge_frames: int = 2) -> np.ndarray:
+    """
+    Calculates the summary features of many time series at once, ignoring NaN values.
+
+    Args:
+    - Y (np.ndarray): (pixels, frames) intensities
+    - T (np.ndarray): (pixels, frames) times of the intensities
+    - edge_frames (int): number of frames at the start and end averaged for the initial and final levels. Default 2
+
+    Returns:
+    - np.ndarray: (pixels, 4) array of onset, slope, ratio and plateau (see SUMMARY_FEATURES). NaN where undefined.
+    """
+    Y = Y.astype(np.float64)
+    T = T.astype(np.float64)
+    valid = ~np.isnan(Y) & ~np.isnan(T)
+    initial = _masked_mean(Y[:, :edge_frames], valid[:, :edge_frames])
+    final = _masked_mean(Y[:, -edge_frames:], valid[:, -edge_frames:])
+
+    # least squares slope over all valid points
+    t_mean = _masked_mean(T, valid)
+    y_mean = _masked_mean(Y, valid)
+    dt = np.where(valid, T - t_mean[:, None], 0)
+    dy = np.where(valid, Y - y_mean[:, None], 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (dt*dy).sum(axis=1)/(dt*dt).sum(axis=1)
+        ratio = final/initial
+    ratio[~np.isfinite(ratio)] = np.nan
+
+    # onset: first valid point past halfway between the initial and final level
+    step = final - initial
+    crossed = valid & (((Y - initial[:, None])*np.sign(step)[:, None]) >= 0.5*np.abs(step)[:, None])
+    has_onset = crossed.any(axis=1) & (step != 0)
+    first = crossed.argmax(axis=1)
+    onset = np.where(has_onset, T[np.arange(len(T)), first], np.nan)
+    plateau = _masked_mean(Y, valid & (T >= onset[:, None]))
+    plateau = np.where(has_onset, plateau, final)
+    return np.stack((onset, slope, ratio, plateau), axis=1)
+
+
+def _times_block(f: h5py.File, rows: slice, t0: float) -> Optional[np.ndarray]:
+    if '/registered/unix_time' not in f:
+        return None
+    return read_pixel_block([f['/registered/unix_time']], rows, np.float64) - t0
+
+
+def features_params(f: h5py.File, elements: List[str], n_components: int, edge_frames: int, n_samples: int, random_state: int) -> dict:
+    """Everything the features depend on. The registration transforms are included as a hash, so re-registering invalidates the cache"""
+    params = {'elements': list(elements), 'n_components': n_components, 'edge_frames': edge_frames,
+              'n_samples': n_samples, 'random_state': random_state}
+    if '/registered/transforms' in f:
+        params['transforms'] = hashlib.sha1(np.ascontiguousarray(f['/registered/transforms'][()]).tobytes()).hexdigest()[:16]
+    return params
+
+
+def load_features(f: h5py.File, params: dict = None) -> Optional[List[h5py.Dataset]]:
+    """
+    Returns the cached feature datasets [/features/summary, /features/pca] of an opened stack file,
+    or None if there are none or they were calculated with other parameters.
+    """
+    if '/features' not in f:
+        return None
+    if params is not None and f['/features'].attrs.get('params') != json.dumps(params, sort_keys=True):
+        return None
+    return [f['/features/summary'], f['/features/pca']]
+
+
+def feature_names(f: h5py.File) -> List[str]:
+    """Names of the features of load_features, in order"""
+    g = f['/features']
+    return [str(name) for name in g['summary'].attrs['names']] + [str(name) for name in g['pca'].attrs['names']]
+
+
+def compute_features(f: h5py.File, elements: List[str], n_components: int = 10, edge_frames: int = 2, n_samples: int = 50000,
+                     block_rows: int = 16, random_state: int = 0) -> List[h5py.Dataset]:
+    """
+    Calculates the features of all pixels of the registered stacks of the elements and stores them under /features.
+    The data is streamed three times: for the normalisation statistics, for the summaries and the PCA sample,
+    and for the PCA projection.
+
+    Args:
+    - f (h5py.File): stack file opened in r+ mode, with registered stacks
+    - elements (List[str]): elements to calculate features of
+    - n_components (int): number of principal components of the normalised time series of all elements. Default 10
+    - edge_frames (int): see time_series_summaries. Default 2
+    - n_samples (int): approximate number of pixels used to fit the PCA. Default 50000
+    - block_rows (int): rows read at once. Default 16
+    - random_state (int): seed of the pixel sample and the PCA. Default 0
+
+    Returns:
+    - List[h5py.Dataset]: the summary (4 x elements, rows, cols) and pca (n_components, rows, cols) datasets
+    """
+    t_start = time.time()
+    params = features_params(f, elements, n_components, edge_frames, n_samples, random_state)
+    rng = np.random.default_rng(random_state)
+    datasets = [f[f'/registered/line_intensities/{element}'] for element in elements]
+    n_frames, n_rows, n_cols = datasets[0].shape
+    n_pixels = n_rows*n_cols
+    mean, std = pixel_statistics(datasets, block_rows)
+
+    has_time = '/registered/unix_time' in f
+    t0 = np.nanmin(f['/registered/unix_time'][0]) if has_time else 0
+    frame_index = np.arange(n_frames, dtype=np.float64)
+    summary = np.full((len(elements)*len(SUMMARY_FEATURES), n_rows, n_cols), np.nan, dtype=np.float32)
+    sample = []
+    sample_fraction = min(1, n_samples/n_pixels)
+    for rows, X in iter_pixel_blocks(datasets, block_rows):
+        T = _times_block(f, rows, t0)
+        if T is None:
+            T = np.broadcast_to(frame_index, (len(X), n_frames))
+        block_summary = [time_series_summaries(X[:, i*n_frames:(i + 1)*n_frames], T, edge_frames) for i in range(len(elements))]
+        block_summary = np.concatenate(block_summary, axis=1)
+        summary[:, rows, :] = block_summary.T.reshape(-1, rows.stop - rows.start, n_cols)
+        # stratified by block: every block contributes the same fraction of its valid pixels
+        X, valid = normalise_block(X, mean, std)
+        X = X[valid]
+        sample.append(X[rng.random(len(X)) < sample_fraction])
+    sample = np.concatenate(sample, axis=0)
+    pca = PCA(n_components=min(n_components, *sample.shape), svd_solver='randomized', random_state=random_state).fit(sample)
+
+    projection = np.full((pca.n_components_, n_rows, n_cols), np.nan, dtype=np.float32)
+    for rows, X in iter_pixel_blocks(datasets, block_rows):
+        X, valid = normalise_block(X, mean, std)
+        block_projection = np.full((len(X), pca.n_components_), np.nan, dtype=np.float32)
+        if valid.any():
+            block_projection[valid] = pca.transform(X[valid])
+        projection[:, rows, :] = block_projection.T.reshape(-1, rows.stop - rows.start, n_cols)
+
+    if '/features' in f:
+        del f['/features']
+    g = f.create_group('/features')
+    g.attrs['params'] = json.dumps(params, sort_keys=True)
+    ds_summary = g.create_dataset('summary', data=summary, chunks=(1, n_rows, n_cols))
+    ds_summary.attrs['names'] = [f'{element}_{name}' for element in elements for name in SUMMARY_FEATURES]
+    ds_summary.attrs['time_units'] = 's' if has_time else 'frames'
+    ds_pca = g.create_dataset('pca', data=projection, chunks=(1, n_rows, n_cols))
+    ds_pca.attrs['names'] = [f'pc{i}' for i in range(pca.n_components_)]
+    ds_pca.attrs['explained_variance_ratio'] = pca.explained_variance_ratio_
+    g.create_dataset('pca_components', data=pca.components_)
+    g.create_dataset('mean', data=mean)
+    g.create_dataset('std', data=std)
+    dt = time.time() - t_start
+    n_features = len(elements)*n_frames
+    print(f'Features: {n_pixels} pixels, {n_features} values per pixel reduced to {len(summary) + len(projection)} features '
+          f'in {dt:.1f} s ({n_pixels/dt:.0f} px/s)')
+    return [ds_summary, ds_pca]
+
+
+def ensure_features(f: h5py.File, elements: List[str], refresh: bool = False, **kwargs) -> List[h5py.Dataset]:
+    """Returns the cached features of an opened stack file, calculating them first if they are missing or outdated.
+    kwargs are passed to compute_features"""
+    defaults = {'n_components': 10, 'edge_frames': 2, 'n_samples': 50000, 'random_state': 0}
+    defaults.update({key: value for key, value in kwargs.items() if key in defaults})
+    params = features_params(f, elements, **defaults)
+    cached = None if refresh else load_features(f, params)
+    if cached is not None:
+        print('Using cached features')
+        return cached
+    return compute_features(f, elements, **kwargs)
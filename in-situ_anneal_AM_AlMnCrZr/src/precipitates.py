@@ -0,0 +1,266 @@
+#
+# Detection of precipitates as bright blobs in the registered stacks, and tracking of the precipitates over the frames.
+#
+# Blobs are found with a difference of Gaussians (DoG) scale-space search, as in skimage.feature.blob_dog, but on batches
+# of frames at once: every Gaussian is applied to a (frames, rows, cols) block with sigma 0 along the frame axis,
+# and the local maxima of the (frames, scales, rows, cols) DoG cube are found with one maximum filter.
+# NaN pixels (outside the registered area) are handled with normalised convolution, so the edges do not produce blobs.
+# A blob is kept if its DoG response is larger than threshold times the robust noise (scaled median absolute deviation) of its frame.
+# Batches of frames are processed in parallel worker processes, each reading its frames from the stack file.
+# Blobs of consecutive frames are linked into tracks with a cKDTree nearest neighbour search (link_tracks), so the nucleation
+# (first frame of a track) and growth of every precipitate can be followed.
+# The blobs and per-frame counts, mean radius and intensity and mean unix_time are saved in the stack file under /precipitates,
+# to be plotted against the temperature.
+# precipitates()
+# detect_precipitates()
+# link_tracks()
+# load_precipitates()
+import os
+import time
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import numpy as np
+import pandas as pd
+import pymongo
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from typing import Tuple
+
+BLOB_COLUMNS = ['frame', 'row', 'col', 'sigma', 'radius', 'response', 'intensity', 'track']
+COUNT_COLUMNS = ['count', 'new_tracks', 'mean_radius', 'mean_intensity', 'unix_time']
+
+
+def blob_sigmas(min_sigma : float, max_sigma : float, sigma_ratio : float = 1.6) -> np.ndarray:
+    """Geometric series of Gaussian sigmas from min_sigma to (at least) max_sigma, as in skimage.feature.blob_dog"""
+    k = int(np.log(max_sigma/min_sigma)/np.log(sigma_ratio)) + 1
+    return min_sigma*sigma_ratio**np.arange(k + 1)
+
+
+def nan_gaussian_stack(frames : np.ndarray, sigma : float, min_weight : float = 0.5) -> np.ndarray:
+    """
+    Gaussian filter of every frame of a (frames, rows, cols) stack, ignoring NaN values (normalised convolution).
+    Pixels where less than min_weight of the kernel covers valid pixels are NaN.
+    """
+    valid = np.isfinite(frames)
+    data = np.where(valid, frames, 0).astype(np.float32)
+    weight = ndimage.gaussian_filter(valid.astype(np.float32), (0, sigma, sigma), mode='constant')
+    smoothed = ndimage.gaussian_filter(data, (0, sigma, sigma), mode='constant')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weight >= min_weight, smoothed/weight, np.nan)
+
+
+def frame_noise(frames : np.ndarray) -> np.ndarray:
+    """Robust standard deviation (1.4826 x median absolute deviation) of every frame, ignoring NaN values"""
+    flat = frames.reshape(len(frames), -1)
+    median = np.nanmedian(flat, axis=1, keepdims=True)
+    noise = 1.4826*np.nanmedian(np.abs(flat - median), axis=1)
+    return np.where(noise > 0, noise, np.nan)
+
+
+def detect_blobs(frames : np.ndarray, sigmas : np.ndarray, threshold : float = 5, frame_offset : int = 0) -> np.ndarray:
+    """
+    Finds bright blobs in all frames of a (frames, rows, cols) block at once.
+
+    Args:
+    - frames (np.ndarray) : (frames, rows, cols) intensities, NaN outside the registered area
+    - sigmas (np.ndarray) : Gaussian sigmas, see blob_sigmas. Blobs are searched at all but the last
+    - threshold (float) : minimum DoG response in units of the noise of the frame. Default 5
+    - frame_offset (int) : index of the first frame of the block in the stack. Default 0
+
+    Returns:
+    - np.ndarray : (blobs, 7) array with columns frame, row, col, sigma, radius (sigma*sqrt(2)), response (DoG in noise units)
+        and intensity (Gaussian smoothed intensity at the centre and scale of the blob)
+    """
+    smoothed = np.stack([nan_gaussian_stack(frames, sigma) for sigma in sigmas], axis=1) # (frames, scales + 1, rows, cols)
+    # scale normalised DoG, see skimage.feature.blob_dog
+    sigma_ratio = np.mean(sigmas[1:]/sigmas[:-1])
+    dog = (smoothed[:, :-1] - smoothed[:, 1:])/(sigma_ratio - 1)
+    dog /= frame_noise(frames)[:, None, None, None]
+    dog = np.nan_to_num(dog, nan=-np.inf)
+    peaks = (dog == ndimage.maximum_filter(dog, size=(1, 3, 3, 3), mode='constant', cval=-np.inf)) & (dog > threshold)
+    frame, scale, row, col = np.nonzero(peaks)
+    sigma = sigmas[scale]
+    return np.column_stack((frame + frame_offset, row, col, sigma, sigma*np.sqrt(2), dog[frame, scale, row, col],
+                            smoothed[frame, scale, row, col]))
+
+
+def _detect_frames(task : tuple) -> np.ndarray:
+    """Worker: detects the blobs of frames start:stop of a dataset of a stack file"""
+    file_path, path, start, stop, sigmas, threshold = task
+    with h5py.File(file_path, 'r') as f:
+        frames = f[path][start:stop].astype(np.float32)
+    return detect_blobs(frames, sigmas, threshold, start)
+
+
+def link_tracks(blobs : np.ndarray, max_distance : float = 3, max_gap : int = 1) -> np.ndarray:
+    """
+    Links blobs of consecutive frames into tracks. Every blob is linked to the nearest unlinked blob of a track that was last
+    seen at most max_gap frames before and is at most max_distance pixels away (closest pairs first), otherwise it starts a new track.
+
+    Args:
+    - blobs (np.ndarray) : (blobs, >= 3) array with columns frame, row, col, sorted by frame
+    - max_distance (float) : maximum distance in pixels between the positions of a track in two frames. Default 3
+    - max_gap (int) : number of frames a precipitate may be missed (e.g. below the threshold) and still be linked. Default 1
+
+    Returns:
+    - np.ndarray : track index of every blob
+    """
+    tracks = np.full(len(blobs), -1, dtype=np.int64)
+    frames = blobs[:, 0].astype(np.int64)
+    track_positions = np.empty((0, 2))
+    track_last_frame = np.empty(0, dtype=np.int64)
+    for frame in np.unique(frames):
+        indices = np.nonzero(frames == frame)[0]
+        positions = blobs[indices, 1:3]
+        assigned = np.full(len(indices), -1, dtype=np.int64)
+        active = np.nonzero(track_last_frame >= frame - 1 - max_gap)[0]
+        if len(active):
+            pairs = cKDTree(positions).sparse_distance_matrix(cKDTree(track_positions[active]), max_distance, output_type='ndarray')
+            used = set()
+            for blob, track, _ in pairs[np.argsort(pairs['v'], kind='stable')]:
+                if assigned[blob] < 0 and track not in used:
+                    assigned[blob] = active[track]
+                    used.add(track)
+        new = assigned < 0
+        assigned[new] = len(track_positions) + np.arange(new.sum())
+        track_positions = np.concatenate((track_positions, np.empty((new.sum(), 2))))
+        track_last_frame = np.concatenate((track_last_frame, np.empty(new.sum(), dtype=np.int64)))
+        track_positions[assigned] = positions
+        track_last_frame[assigned] = frame
+        tracks[indices] = assigned
+    return tracks
+
+
+def frame_counts(blobs : np.ndarray, n_frames : int) -> dict:
+    """Per-frame number of blobs, number of new tracks (nucleation), mean radius and mean intensity of a blob table with a track column"""
+    frames = blobs[:, 0].astype(np.int64)
+    count = np.bincount(frames, minlength=n_frames)
+    first_frames = np.full(int(blobs[:, 7].max()) + 1 if len(blobs) else 0, n_frames)
+    np.minimum.at(first_frames, blobs[:, 7].astype(np.int64), frames)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {
+            'count': count,
+            'new_tracks': np.bincount(first_frames, minlength=n_frames + 1)[:n_frames],
+            'mean_radius': np.bincount(frames, blobs[:, 4], n_frames)/count,
+            'mean_intensity': np.bincount(frames, blobs[:, 6], n_frames)/count,
+        }
+
+
+def detect_precipitates(file_path : str, element : str = 'Mn_Ka', min_sigma : float = 1, max_sigma : float = 8, sigma_ratio : float = 1.6,
+                        threshold : float = 5, max_distance : float = 3, max_gap : int = 1, n_workers : int = 4,
+                        frames_per_task : int = 8) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Detects and tracks the precipitates in the registered stack of an element, and saves them under /precipitates/<element>.
+
+    Args:
+    - file_path (str) : stack file with registered stacks
+    - element (str) : element to detect precipitates in. Default 'Mn_Ka'
+    - min_sigma, max_sigma, sigma_ratio (float) : scales searched, see blob_sigmas. Default 1, 8 and 1.6 pixels
+    - threshold (float) : see detect_blobs. Default 5
+    - max_distance, max_gap : see link_tracks. Default 3 pixels and 1 frame
+    - n_workers (int) : number of worker processes. Default 4
+    - frames_per_task (int) : frames filtered together by a worker. Memory per worker is about
+        frames_per_task x (number of sigmas + 1) x frame size x 4 bytes. Default 8
+
+    Returns:
+    - blobs, counts (pd.DataFrame) : see load_precipitates
+    """
+    t0 = time.time()
+    path = f'/registered/line_intensities/{element}'
+    with h5py.File(file_path, 'r') as f:
+        n_frames = f[path].shape[0]
+    sigmas = blob_sigmas(min_sigma, max_sigma, sigma_ratio)
+    tasks = [(file_path, path, start, min(start + frames_per_task, n_frames), sigmas, threshold)
+             for start in range(0, n_frames, frames_per_task)]
+    n_workers = max(1, min(n_workers, len(tasks)))
+    if n_workers == 1:
+        results = [_detect_frames(task) for task in tasks]
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+            results = list(executor.map(_detect_frames, tasks))
+    blobs = np.concatenate(results, axis=0) if results else np.empty((0, 7))
+    blobs = np.column_stack((blobs, link_tracks(blobs, max_distance, max_gap)))
+    counts = frame_counts(blobs, n_frames)
+
+    params = {'element': element, 'min_sigma': min_sigma, 'max_sigma': max_sigma, 'sigma_ratio': sigma_ratio, 'threshold': threshold,
+              'max_distance': max_distance, 'max_gap': max_gap}
+    with h5py.File(file_path, 'r+') as f:
+        if '/registered/unix_time' in f:
+            counts['unix_time'] = np.array([np.nanmean(frame) if np.isfinite(frame).any() else np.nan
+                                            for frame in f['/registered/unix_time']])
+        group_path = f'/precipitates/{element}'
+        if group_path in f:
+            del f[group_path]
+        g = f.create_group(group_path)
+        g.attrs['params'] = json.dumps(params, sort_keys=True)
+        ds = g.create_dataset('blobs', data=blobs)
+        ds.attrs['columns'] = BLOB_COLUMNS
+        counts_g = g.create_group('counts')
+        for name, data in counts.items():
+            counts_g.create_dataset(name, data=data)
+    n_tracks = int(blobs[:, 7].max()) + 1 if len(blobs) else 0
+    print(f'Precipitates {element}: {len(blobs)} blobs in {n_frames} frames, {n_tracks} tracks in {time.time() - t0:.1f} s')
+    return _to_frames(blobs, counts)
+
+
+def _to_frames(blobs : np.ndarray, counts : dict) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    blobs = pd.DataFrame(blobs, columns=BLOB_COLUMNS).astype({'frame': np.int64, 'row': np.int64, 'col': np.int64, 'track': np.int64})
+    counts = pd.DataFrame({name: counts[name] for name in COUNT_COLUMNS if name in counts}).rename_axis('frame').reset_index()
+    return blobs, counts
+
+
+def load_precipitates(f : h5py.File, element : str = 'Mn_Ka') -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Returns the precipitates saved by detect_precipitates in an opened stack file.
+
+    Returns:
+    - blobs (pd.DataFrame) : one row per blob with the columns of BLOB_COLUMNS
+    - counts (pd.DataFrame) : one row per frame with count, new_tracks, mean_radius, mean_intensity and unix_time (if the stack has times)
+    """
+    g = f[f'/precipitates/{element}']
+    counts = {name: ds[()] for name, ds in g['counts'].items()}
+    return _to_frames(g['blobs'][()], counts)
+
+
+def precipitates(beamline : str, config_path : str, sample_name : str = None, scan_type : str = None) -> None:
+    """
+    Detects the precipitates in all stacks of a beamline (optionally of one sample and scan type).
+    The config of the beamline has the keys:
+    - elements : elements to detect precipitates in
+    - optional: the arguments of detect_precipitates (min_sigma, max_sigma, sigma_ratio, threshold, max_distance, max_gap,
+        n_workers, frames_per_task)
+    """
+    with open(config_path, 'r') as f:
+        config = json.load(f)[beamline]
+    print(config)
+    elements = config.pop('elements')
+
+    client = pymongo.MongoClient('mongodb://localhost/')
+    db = client['in_situ_fluo']
+    stack_coll = db['stacks']
+    query = {'beamline': beamline}
+    if sample_name is not None:
+        query['sample_name'] = sample_name
+    if scan_type is not None:
+        query['scan_type'] = scan_type
+    try:
+        for doc in stack_coll.find(query):
+            print('Detecting precipitates ' + doc['beamline'] + " " + doc['sample_name'] + " " + doc['scan_type'])
+            for element in elements:
+                try:
+                    detect_precipitates(doc['file_path'], element, **config)
+                except Exception as e:
+                    print(f'Precipitate detection failed: {e!r}')
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    beamline = 'P06'
+    fname = os.path.splitext(__file__)[0]
+
+    config_path = f'{fname}.json'
+    precipitates(beamline, config_path)
@@ -0,0 +1,195 @@
+#
+# Statistics of labelled regions of registered stacks, e.g. to follow the Mn and Cr intensity of precipitates over time.
+#
+# A label image (rows, cols) assigns every pixel of the registered stack to a region: a label map from clustering.py
+# (e.g. 'kmeans_4' for /clustering/kmeans_4/labels) or a manual mask. Negative labels are ignored, and for boolean masks
+# the pixels inside the mask are region 1.
+# For every element, region and frame the sum, mean, standard deviation and number of valid (non-NaN) pixels are calculated,
+# together with the mean unix_time of the region in each frame. Blocks of rows are streamed from the stack (from the time-major
+# copies if they exist, see stack_io.write_time_major), and all elements, frames and regions of a block are accumulated
+# with one np.bincount per statistic, so there are no Python loops over regions or frames.
+# Results are returned as a tidy DataFrame with one row per (element, label, frame), and cached in the stack file
+# under /region_stats/<name>. The cache is recalculated when the labels, the elements or the registration transforms change.
+# region_stats()
+# load_region_stats()
+import json
+import hashlib
+import h5py
+import numpy as np
+import pandas as pd
+from typing import List, Optional, Tuple, Union
+from stack_io import row_blocks, read_pixel_block, TIME_MAJOR_TILE
+
+STATISTICS = ['sum', 'mean', 'std', 'count']
+
+
+def _hash(data: np.ndarray) -> str:
+    return hashlib.sha1(np.ascontiguousarray(data).tobytes()).hexdigest()[:16]
+
+
+def label_image(f: h5py.File, labels: Union[str, np.ndarray]) -> Tuple[np.ndarray, str]:
+    """
+    Returns a label image as an int64 array, and a name for the cache.
+
+    Args:
+    - f (h5py.File): Opened stack file.
+    - labels (str or np.ndarray): Name of a clustering result (e.g. 'kmeans_4' or 'ward_6'), path of a label dataset
+        in the stack file, or a (rows, cols) array of labels or a boolean mask.
+
+    Returns:
+    - np.ndarray: (rows, cols) labels, negative for pixels outside all regions.
+    - str: Name of the labels, e.g. 'kmeans_4', or 'mask' for arrays.
+    """
+    if isinstance(labels, str):
+        path = labels if labels.startswith('/') else f'/clustering/{labels}/labels'
+        name = path.strip('/').split('/')[-2] if path.endswith('/labels') else path.strip('/').replace('/', '_')
+        return f[path][()].astype(np.int64), name
+    labels = np.asarray(labels)
+    if labels.dtype == bool:
+        labels = np.where(labels, 1, -1)
+    return labels.astype(np.int64), 'mask'
+
+
+def region_stats_key(f: h5py.File, label_map: np.ndarray, elements: List[str]) -> dict:
+    """Everything the statistics depend on. The labels and the registration transforms are included as hashes"""
+    key = {'elements': list(elements), 'labels': _hash(label_map)}
+    if '/registered/transforms' in f:
+        key['transforms'] = _hash(f['/registered/transforms'][()])
+    return key
+
+
+def compute_region_stats(f: h5py.File, label_map: np.ndarray, elements: List[str], block_rows: int = TIME_MAJOR_TILE) -> dict:
+    """
+    Streams over the registered stacks once and accumulates the statistics of all regions.
+
+    Args:
+    - f (h5py.File): Opened stack file with registered stacks.
+    - label_map (np.ndarray): (rows, cols) labels, see label_image.
+    - elements (List[str]): Elements under /registered/line_intensities.
+    - block_rows (int): Rows read at once. Default 32, the tile size of the time-major copies.
+
+    Returns:
+    - dict: 'labels' (labels,), 'sum', 'mean', 'std', 'count' (elements, frames, labels) and 'unix_time' (frames, labels) arrays.
+        Statistics of regions without valid pixels in a frame are NaN (count 0).
+    """
+    datasets = [f[f'/registered/line_intensities/{element}'] for element in elements]
+    n_frames, n_rows, n_cols = datasets[0].shape
+    if label_map.shape != (n_rows, n_cols):
+        raise ValueError(f'Label image of shape {label_map.shape} does not match the registered frames {(n_rows, n_cols)}')
+    labels = np.unique(label_map[label_map >= 0])
+    n_labels = len(labels)
+    index_map = np.searchsorted(labels, label_map)
+
+    # bin of every (element, frame, label) is (element*n_frames + frame)*n_labels + label index
+    n_bins = len(elements)*n_frames*n_labels
+    offsets = np.arange(len(elements)*n_frames)[:, None]*n_labels
+    total = np.zeros(n_bins)
+    total_sq = np.zeros(n_bins)
+    count = np.zeros(n_bins)
+    time_ds = f['/registered/unix_time'] if '/registered/unix_time' in f else None
+    time_total = np.zeros(n_frames*n_labels)
+    time_count = np.zeros(n_frames*n_labels)
+    for rows in row_blocks(n_rows, block_rows):
+        labelled = label_map[rows].ravel() >= 0
+        if not labelled.any():
+            continue
+        index = index_map[rows].ravel()[labelled]
+        X = read_pixel_block(datasets, rows, np.float64)[labelled].T # (elements*frames, pixels)
+        valid = ~np.isnan(X)
+        bins = (offsets + index)[valid]
+        values = X[valid]
+        total += np.bincount(bins, values, n_bins)
+        total_sq += np.bincount(bins, values*values, n_bins)
+        count += np.bincount(bins, minlength=n_bins)
+        if time_ds is not None:
+            T = read_pixel_block([time_ds], rows, np.float64)[labelled].T # (frames, pixels)
+            valid = ~np.isnan(T)
+            bins = (offsets[:n_frames] + index)[valid]
+            time_total += np.bincount(bins, T[valid], n_frames*n_labels)
+            time_count += np.bincount(bins, minlength=n_frames*n_labels)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total/count
+        std = np.sqrt(np.maximum(total_sq/count - mean**2, 0))
+        unix_time = time_total/time_count
+    shape = (len(elements), n_frames, n_labels)
+    return {'labels': labels, 'sum': np.where(count > 0, total, np.nan).reshape(shape), 'mean': mean.reshape(shape),
+            'std': std.reshape(shape), 'count': count.astype(np.int64).reshape(shape), 'unix_time': unix_time.reshape(n_frames, n_labels)}
+
+
+def stats_to_frame(stats: dict, elements: List[str]) -> pd.DataFrame:
+    """Converts the arrays of compute_region_stats to a tidy DataFrame with columns element, label, frame, sum, mean, std, count and unix_time"""
+    n_elements, n_frames, n_labels = stats['sum'].shape
+    df = pd.DataFrame({
+        'element': pd.Categorical(np.repeat(elements, n_frames*n_labels), categories=elements),
+        'label': np.tile(stats['labels'], n_elements*n_frames),
+        'frame': np.tile(np.repeat(np.arange(n_frames), n_labels), n_elements),
+        **{name: stats[name].ravel() for name in STATISTICS},
+        'unix_time': np.tile(stats['unix_time'].ravel(), n_elements),
+    })
+    return df
+
+
+def load_region_stats(f: h5py.File, name: str, key: dict = None) -> Optional[pd.DataFrame]:
+    """
+    Returns the cached statistics /region_stats/<name> of an opened stack file as a DataFrame,
+    or None if there are none or they were calculated from other labels, elements or transforms.
+    """
+    path = f'/region_stats/{name}'
+    if path not in f:
+        return None
+    g = f[path]
+    if key is not None and g.attrs.get('key') != json.dumps(key, sort_keys=True):
+        return None
+    elements = [str(element) for element in g.attrs['elements']]
+    stats = {dataset_name: g[dataset_name][()] for dataset_name in ['labels', 'unix_time'] + STATISTICS}
+    return stats_to_frame(stats, elements)
+
+
+def save_region_stats(f: h5py.File, name: str, stats: dict, elements: List[str], key: dict) -> None:
+    """Stores the arrays of compute_region_stats under /region_stats/<name> in a stack file opened in r+ mode"""
+    path = f'/region_stats/{name}'
+    if path in f:
+        del f[path]
+    g = f.create_group(path)
+    for dataset_name, data in stats.items():
+        g.create_dataset(dataset_name, data=data)
+    g.attrs['elements'] = list(elements)
+    g.attrs['key'] = json.dumps(key, sort_keys=True)
+
+
+def region_stats(f: h5py.File, labels: Union[str, np.ndarray], elements: List[str] = None, name: str = None,
+                 refresh: bool = False, block_rows: int = TIME_MAJOR_TILE) -> pd.DataFrame:
+    """
+    Per-region, per-frame statistics of the registered stacks, read from the cache in the stack file if it is up to date.
+
+    Args:
+    - f (h5py.File): Opened stack file. The statistics are only cached if it is opened in r+ mode.
+    - labels (str or np.ndarray): Clustering result, label dataset or label array, see label_image.
+    - elements (List[str], optional): Elements to calculate statistics of. Defaults to all registered elements.
+    - name (str, optional): Name of the cache under /region_stats. Defaults to the name of the labels, e.g. 'kmeans_4' or 'mask'.
+    - refresh (bool): Recalculate even if the cache is up to date. Default False.
+    - block_rows (int): Rows read at once. Default 32.
+
+    Returns:
+    - pd.DataFrame: One row per (element, label, frame) with columns sum, mean, std, count (valid pixels) and unix_time (mean time the region was measured).
+
+    Example:
+        with h5py.File(doc['file_path'], 'r+') as f:
+            df = region_stats(f, 'kmeans_4', ['Mn_Ka', 'Cr_Ka'])
+        df.pivot_table(index='unix_time', columns=['element', 'label'], values='mean')
+    """
+    label_map, default_name = label_image(f, labels)
+    if name is None:
+        name = default_name
+    if elements is None:
+        elements = list(f['/registered/line_intensities'])
+    key = region_stats_key(f, label_map, elements)
+    cached = None if refresh else load_region_stats(f, name, key)
+    if cached is not None:
+        print(f'Using cached region statistics {name}')
+        return cached
+    stats = compute_region_stats(f, label_map, elements, block_rows)
+    if f.mode == 'r+':
+        save_region_stats(f, name, stats, elements, key)
+    return stats_to_frame(stats, elements)
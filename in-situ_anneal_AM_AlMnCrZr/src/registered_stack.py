@@ -0,0 +1,152 @@
+#
+# Lazy, on-read access to registered stacks.
+#
+# Instead of reading the materialised /registered datasets, RegisteredStack reads the /unregistered datasets and the
+# transforms stored under /registered/transforms (see stack_registration.py), and warps frames when they are indexed.
+# All elements of a frame are warped together in one cv2.remap call, and the most recently used warped frames are kept in a small cache.
+# Usage:
+#   with RegisteredStack(doc['file_path']) as stack:
+#       mn = stack['Mn_Ka'][10]          # one registered frame
+#       times = stack['unix_time'][:]     # all frames of the pixel times
+import h5py
+import cv2
+import numpy as np
+from collections import OrderedDict
+from typing import List
+from stack_registration import load_transforms, load_skipped_frames, crop_box, remap_grids, remap_channels
+
+AUX_PATHS = ['unix_time', 'positions/positions_fast', 'positions/positions_slow']
+
+
+class RegisteredDataset:
+    """
+    View of one registered dataset (an element, unix_time or positions) of a RegisteredStack.
+    Supports len(), .shape and indexing along the frame axis with an int, a slice or a list of ints.
+    A single frame is a read-only view of the cached warped frame, use .copy() to modify it.
+    Indexing with a tuple applies the remaining indices to the warped frames, e.g. view[:, 10:20, 10:20].
+    """
+    def __init__(self, stack: 'RegisteredStack', kind: str, channel: int, name: str):
+        self.stack = stack
+        self.kind = kind
+        self.channel = channel
+        self.name = name
+
+    @property
+    def shape(self):
+        return self.stack.shape
+
+    @property
+    def dtype(self):
+        return self.stack.dtypes[self.kind]
+
+    def __len__(self):
+        return self.stack.shape[0]
+
+    def frame(self, i: int) -> np.ndarray:
+        return self.stack.warped_frame(self.kind, i)[..., self.channel]
+
+    def __getitem__(self, index):
+        rest = ()
+        if isinstance(index, tuple):
+            index, rest = index[0], index[1:]
+        if isinstance(index, (int, np.integer)):
+            return self.frame(int(index))[rest]
+        if isinstance(index, slice):
+            frame_indices = range(*index.indices(len(self)))
+        else:
+            frame_indices = list(index)
+        return np.stack([self.frame(i)[rest] for i in frame_indices], axis=0)
+
+    def __array__(self, dtype=None, copy=None):
+        if copy is False:
+            raise ValueError('A RegisteredDataset is warped on demand and can not be converted to an array without a copy')
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+
+class RegisteredStack:
+    """
+    Registered view of a stack file, warping the unregistered datasets with the stored transforms on demand.
+
+    Attributes:
+        file_path (str): Path of the stack file.
+        ref_element (str): Element the transforms were calculated from.
+        elements (List[str]): Names of the elements under /unregistered/line_intensities.
+        shape (tuple): (frames, rows, cols) of the registered frames.
+        skipped (set): Frames that were left out of the registration. They are returned as NaN.
+
+    Parameters:
+        file_path (str): Path of a stack file with /registered/transforms.
+        cache_size (int, optional): Number of warped frames (all elements of one frame count as one) to keep in memory. Defaults to 16.
+    """
+    def __init__(self, file_path: str, cache_size: int = 16):
+        self.file_path = file_path
+        self.cache_size = cache_size
+        self.file = h5py.File(file_path, 'r')
+        self.cumulative, self.ref_element = load_transforms(self.file)
+        self.rows, self.cols = crop_box(self.file, self.ref_element)
+        self.shape = (len(self.cumulative), self.rows.stop - self.rows.start, self.cols.stop - self.cols.start)
+        self.skipped = set(load_skipped_frames(self.file))
+
+        unregistered_g = self.file['/unregistered']
+        self.elements = list(unregistered_g['line_intensities'])
+        self.aux_paths = [path for path in AUX_PATHS if path in unregistered_g]
+        self._datasets = {
+            'line_intensities': [unregistered_g['line_intensities'][element] for element in self.elements],
+            'aux': [unregistered_g[path] for path in self.aux_paths],
+        }
+        self.dtypes = {
+            'line_intensities': np.result_type(np.float32, *[ds.dtype for ds in self._datasets['line_intensities']]),
+            'aux': np.dtype(np.float64),
+        }
+        self._interpolation = {'line_intensities': cv2.INTER_LINEAR, 'aux': cv2.INTER_NEAREST}
+        self._cache = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.file.close()
+        self._cache.clear()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __contains__(self, name: str):
+        return name in self.elements or name in self.aux_paths
+
+    def keys(self) -> List[str]:
+        return self.elements + self.aux_paths
+
+    def __getitem__(self, name: str) -> RegisteredDataset:
+        if name in self.elements:
+            return RegisteredDataset(self, 'line_intensities', self.elements.index(name), name)
+        if name in self.aux_paths:
+            return RegisteredDataset(self, 'aux', self.aux_paths.index(name), name)
+        raise KeyError(name)
+
+    def warped_frame(self, kind: str, i: int) -> np.ndarray:
+        """
+        Returns frame i of all datasets of a kind ('line_intensities' or 'aux') warped together, as an array of shape (rows, cols, channels).
+        Frames are taken from the cache if they were warped recently. The returned array is read-only, since it is shared with the cache.
+        """
+        if i < 0:
+            i += len(self)
+        key = (kind, i)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if i in self.skipped:
+            warped = np.full(self.shape[1:] + (len(self._datasets[kind]),), np.nan, dtype=self.dtypes[kind])
+        else:
+            map_x, map_y = remap_grids(self.cumulative[i], self.shape[1:])
+            frames = [ds[i, self.rows, self.cols] for ds in self._datasets[kind]]
+            warped = remap_channels(frames, map_x, map_y, self._interpolation[kind], self.dtypes[kind])
+        warped.setflags(write=False)
+        self._cache[key] = warped
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return warped
@@ -0,0 +1,447 @@
+#
+# Helpers for reading the stack files created by create_stacks.py
+#
+# Maps of different scans in a stack do not always have the same shape. In the stack file they are padded with NaN
+# (at the bottom and right) to the largest shape, and the valid (rows, cols) extent of each frame is stored
+# in the dataset 'valid_extents' of the group. Using the extents, cropping does not require scanning the data for NaN values.
+# read_valid_extents()
+# read_cropped()
+# read_ragged()
+# For pixel-wise analysis (clustering, features) stacks are streamed as blocks of rows, each reshaped to a (pixels, features) matrix.
+# iter_pixel_blocks()
+# pixel_statistics()
+# Every stack dataset also has downsampled previews (NaN-aware mean pooling by 2, 4 and 8) in a mirrored tree under /pyramids,
+# e.g. /pyramids/registered/line_intensities/Mn_Ka/4x. read_preview() picks the coarsest level that is large enough for a display size.
+# write_pyramids()
+# read_preview()
+# Stacks are stored frame-major (one chunk per frame), which is fast for reading frames but slow for the time series of a pixel or region.
+# write_time_major() writes a companion copy with chunks of (all frames, 32, 32) pixels under /time_major, e.g.
+# /time_major/registered/line_intensities/Mn_Ka, and read_stack() reads from the layout that touches the fewest chunks for a query.
+# write_time_major()
+# read_stack()
+import h5py
+import numpy as np
+from typing import List, Optional, Tuple, Iterator
+
+
+def frame_extents(data_stack: List[np.ndarray]) -> np.ndarray:
+    """
+    Returns the (rows, cols) shape of each 2D array in a list, as an (n_frames, 2) integer array.
+    """
+    return np.array([arr.shape[:2] for arr in data_stack], dtype=np.int64).reshape(-1, 2)
+
+
+def common_extent(extents: np.ndarray) -> Tuple[int, int]:
+    """
+    Returns the (rows, cols) extent that is valid in all frames.
+    Since frames are padded at the bottom and right, this is the smallest number of rows and columns.
+    """
+    return int(extents[:, 0].min()), int(extents[:, 1].min())
+
+
+def read_valid_extents(f: h5py.File, group: str = 'unregistered') -> Optional[np.ndarray]:
+    """
+    Reads the valid (rows, cols) extent of each frame of a stack.
+
+    Args:
+    - f (h5py.File): Opened stack file.
+    - group (str): Group containing the 'valid_extents' dataset. Default 'unregistered'.
+
+    Returns:
+    - np.ndarray: (n_frames, 2) array of valid rows and columns, or None if the stack file was created without extents.
+    """
+    path = f'{group}/valid_extents'
+    if path not in f:
+        return None
+    return f[path][()]
+
+
+def crop_to_extents(stack: np.ndarray, extents: np.ndarray) -> np.ndarray:
+    """
+    Crops an in-memory stack to the region that is valid in all frames.
+    """
+    rows, cols = common_extent(extents)
+    return stack[:, :rows, :cols]
+
+
+def read_cropped(dataset: h5py.Dataset, extents: np.ndarray) -> np.ndarray:
+    """
+    Reads a stack cropped to the region that is valid in all frames. Only the cropped region is read from disk.
+
+    Args:
+    - dataset (h5py.Dataset): Stacked dataset of shape (frames, rows, cols).
+    - extents (np.ndarray): (n_frames, 2) array of valid rows and columns.
+
+    Returns:
+    - np.ndarray: Dense array of shape (frames, min rows, min cols) without NaN padding.
+    """
+    rows, cols = common_extent(extents)
+    return dataset[:, :rows, :cols]
+
+
+def read_ragged(dataset: h5py.Dataset, extents: np.ndarray) -> List[np.ndarray]:
+    """
+    Reads a stack as a list of frames, each with its own original shape.
+
+    Args:
+    - dataset (h5py.Dataset): Stacked dataset of shape (frames, rows, cols).
+    - extents (np.ndarray): (n_frames, 2) array of valid rows and columns.
+
+    Returns:
+    - List[np.ndarray]: The frames without NaN padding.
+    """
+    return [dataset[i, :rows, :cols] for i, (rows, cols) in enumerate(extents)]
+
+
+def nan_crop_box(stack: np.ndarray) -> Tuple[slice, slice]:
+    """
+    Finds the region of a NaN padded stack that is valid in all frames, for stack files without 'valid_extents'.
+    The bounding box of each frame is found from np.any reductions along each axis instead of the indices of all valid pixels.
+
+    Args:
+    - stack (np.ndarray): Stack of shape (frames, rows, cols).
+
+    Returns:
+    - (slice, slice): Row and column slices of the region that is valid in all frames.
+
+    Raises:
+    - ValueError: If a frame is all NaN, so no region is valid in all frames.
+    """
+    valid = ~np.isnan(stack)
+    valid_rows = valid.any(axis=2)  # (frames, rows)
+    valid_cols = valid.any(axis=1)  # (frames, cols)
+    # argmax of an all-False frame would be 0, as if the frame were fully valid
+    empty = ~valid_rows.any(axis=1) | ~valid_cols.any(axis=1)
+    if empty.any():
+        raise ValueError(f'Frames {np.nonzero(empty)[0].tolist()} are all NaN, no region is valid in all frames')
+    first_row = valid_rows.argmax(axis=1).max()
+    last_row = stack.shape[1] - 1 - valid_rows[:, ::-1].argmax(axis=1).max()
+    first_col = valid_cols.argmax(axis=1).max()
+    last_col = stack.shape[2] - 1 - valid_cols[:, ::-1].argmax(axis=1).max()
+    return slice(int(first_row), int(last_row) + 1), slice(int(first_col), int(last_col) + 1)
+
+
+def row_blocks(n_rows: int, block_rows: int) -> List[slice]:
+    return [slice(start, min(start + block_rows, n_rows)) for start in range(0, n_rows, block_rows)]
+
+
+def read_pixel_block(datasets: List[h5py.Dataset], rows: slice, dtype=np.float32) -> np.ndarray:
+    """
+    Reads a block of rows of several (frames, rows, cols) datasets as a pixel matrix.
+    The rows are read from the time-major copies of the datasets when they exist and touch fewer chunks (see write_time_major).
+
+    Args:
+    - datasets (List[h5py.Dataset]): datasets of the same shape, e.g. the registered stacks of each element
+    - rows (slice): rows of the block
+    - dtype: dtype of the pixel matrix. Default float32, use float64 for unix_time
+
+    Returns:
+    - X (np.ndarray): array of shape (pixels in block, features), with the frames of the first dataset first.
+        Pixels are in row-major order.
+    """
+    selection = (slice(None), rows, slice(None))
+    blocks = [stack_layout(ds.file, ds.name, selection)[selection].astype(dtype, copy=False) for ds in datasets]
+    X = np.concatenate(blocks, axis=0) # (features, block rows, cols)
+    return X.reshape(X.shape[0], -1).T
+
+
+def iter_pixel_blocks(datasets: List[h5py.Dataset], block_rows: int = 16, order: np.ndarray = None) -> Iterator[Tuple[slice, np.ndarray]]:
+    """Yields (rows, X) for blocks of rows of the datasets, see read_pixel_block. order optionally permutes the blocks"""
+    blocks = row_blocks(datasets[0].shape[1], block_rows)
+    if order is not None:
+        blocks = [blocks[i] for i in order]
+    for rows in blocks:
+        yield rows, read_pixel_block(datasets, rows)
+
+
+def pixel_statistics(datasets: List[h5py.Dataset], block_rows: int = 16, per_frame: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Streams over the datasets once and calculates the mean and standard deviation used to normalise the pixels, ignoring NaN values.
+
+    Args:
+    - datasets (List[h5py.Dataset]): datasets of shape (frames, rows, cols)
+    - block_rows (int): number of rows read at once. Default 16
+    - per_frame (bool): normalise every frame separately (removes changes of the total intensity over time),
+        instead of every dataset as a whole. Default False
+
+    Returns:
+    - mean, std (np.ndarray): arrays of length features (frames times number of datasets)
+    """
+    n_features = sum(ds.shape[0] for ds in datasets)
+    count = np.zeros(n_features)
+    total = np.zeros(n_features)
+    total_sq = np.zeros(n_features)
+    for _, X in iter_pixel_blocks(datasets, block_rows):
+        valid = ~np.isnan(X)
+        X = np.where(valid, X, 0).astype(np.float64)
+        count += valid.sum(axis=0)
+        total += X.sum(axis=0)
+        total_sq += np.einsum('ij,ij->j', X, X)
+    if not per_frame:
+        # pool the frames of each dataset
+        edges = np.cumsum([0] + [ds.shape[0] for ds in datasets])
+        for start, stop in zip(edges[:-1], edges[1:]):
+            count[start:stop] = count[start:stop].sum()
+            total[start:stop] = total[start:stop].sum()
+            total_sq[start:stop] = total_sq[start:stop].sum()
+    count = np.maximum(count, 1)
+    mean = total/count
+    std = np.sqrt(np.maximum(total_sq/count - mean**2, 0))
+    std[std == 0] = 1
+    return mean.astype(np.float32), std.astype(np.float32)
+
+
+def normalise_block(X: np.ndarray, mean: np.ndarray, std: np.ndarray, min_valid_fraction: float = 0.5) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Normalises a pixel matrix in place to zero mean and unit variance, and replaces NaN values by 0 (the mean).
+
+    Args:
+    - X (np.ndarray): (pixels, features) pixel matrix from read_pixel_block
+    - mean, std (np.ndarray): from pixel_statistics
+    - min_valid_fraction (float): pixels with a smaller fraction of non-NaN values are marked invalid. Default 0.5
+
+    Returns:
+    - X (np.ndarray): the normalised pixel matrix
+    - valid (np.ndarray): boolean array of the pixels that can be clustered
+    """
+    nan = np.isnan(X)
+    valid = (1 - nan.mean(axis=1)) >= min_valid_fraction
+    X -= mean
+    X /= std
+    X[nan] = 0
+    return X, valid
+
+
+PYRAMID_FACTORS = (2, 4, 8)
+PYRAMID_GROUP = '/pyramids'
+# datasets that are not (frames, rows, cols) maps and have no pyramid
+PYRAMID_EXCLUDE = ('transforms',)
+
+
+def nan_mean_pool(frames: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Downsamples a stack by averaging blocks of factor x factor pixels, ignoring NaN values.
+    Frames are padded with NaN to a multiple of factor, so the edges are averages of fewer pixels. Blocks without valid pixels are NaN.
+
+    Args:
+    - frames (np.ndarray): Stack of shape (frames, rows, cols).
+    - factor (int): Downsampling factor.
+
+    Returns:
+    - np.ndarray: Stack of shape (frames, ceil(rows/factor), ceil(cols/factor)), float32 or float64 for float64 input (e.g. unix_time).
+    """
+    n, rows, cols = frames.shape
+    out_rows, out_cols = -(-rows//factor), -(-cols//factor)
+    dtype = np.result_type(frames.dtype, np.float32)
+    padded = np.full((n, out_rows*factor, out_cols*factor), np.nan, dtype=dtype)
+    padded[:, :rows, :cols] = frames
+    blocks = padded.reshape(n, out_rows, factor, out_cols, factor)
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(2, 4))
+    total = np.where(valid, blocks, 0).sum(axis=(2, 4))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total/count, np.nan).astype(dtype)
+
+
+def pyramid_path(path: str, factor: int) -> str:
+    return f"{PYRAMID_GROUP}/{path.strip('/')}/{factor}x"
+
+
+def write_pyramid(f: h5py.File, path: str, factors: Tuple[int, ...] = PYRAMID_FACTORS, frames_per_block: int = 16) -> None:
+    """
+    Writes the downsampled levels of one (frames, rows, cols) dataset, reading frames_per_block frames at a time.
+
+    Args:
+    - f (h5py.File): Stack file opened in r+ or w mode.
+    - path (str): Path of the dataset, e.g. '/registered/line_intensities/Mn_Ka'.
+    - factors (Tuple[int, ...]): Downsampling factors. Default (2, 4, 8).
+    - frames_per_block (int): Number of frames read at once. Default 16.
+    """
+    ds = f[path]
+    n_frames, rows, cols = ds.shape
+    levels = {}
+    for factor in factors:
+        level_path = pyramid_path(path, factor)
+        if level_path in f:
+            del f[level_path]
+        shape = (n_frames, -(-rows//factor), -(-cols//factor))
+        levels[factor] = f.create_dataset(level_path, shape=shape, dtype=np.result_type(ds.dtype, np.float32), chunks=(1,) + shape[1:], fillvalue=np.nan)
+        levels[factor].attrs['factor'] = factor
+        levels[factor].attrs['source'] = path
+        if 'units' in ds.attrs:
+            levels[factor].attrs['units'] = ds.attrs['units']
+    for start in range(0, n_frames, frames_per_block):
+        frames = ds[start:start + frames_per_block]
+        for factor, level in levels.items():
+            level[start:start + len(frames)] = nan_mean_pool(frames, factor)
+
+
+def write_pyramids(f: h5py.File, group: str = 'unregistered', factors: Tuple[int, ...] = PYRAMID_FACTORS) -> List[str]:
+    """
+    Writes the pyramids of all (frames, rows, cols) datasets in a group of a stack file (elements, unix_time and positions).
+
+    Returns:
+    - List[str]: Paths of the datasets that got a pyramid.
+    """
+    paths = []
+    def collect(name, obj):
+        if isinstance(obj, h5py.Dataset) and obj.ndim == 3 and name.split('/')[-1] not in PYRAMID_EXCLUDE:
+            paths.append(obj.name)
+    f[group].visititems(collect)
+    for path in paths:
+        write_pyramid(f, path, factors)
+    return paths
+
+
+def pyramid_levels(f: h5py.File, path: str) -> List[int]:
+    """Downsampling factors available for a dataset, from fine to coarse"""
+    group_path = f"{PYRAMID_GROUP}/{path.strip('/')}"
+    if group_path not in f:
+        return []
+    return sorted(int(name[:-1]) for name in f[group_path] if name.endswith('x'))
+
+
+def preview_dataset(f: h5py.File, path: str, display_size: int) -> Tuple[h5py.Dataset, int]:
+    """
+    Picks the coarsest pyramid level of a dataset whose larger side still has at least display_size pixels,
+    or the full resolution dataset if no level is large enough.
+
+    Returns:
+    - (h5py.Dataset, int): The dataset and its downsampling factor (1 for full resolution).
+    """
+    ds = f[path]
+    chosen, factor = ds, 1
+    for level in pyramid_levels(f, path):
+        level_ds = f[pyramid_path(path, level)]
+        if max(level_ds.shape[1:]) >= display_size:
+            chosen, factor = level_ds, level
+    return chosen, factor
+
+
+def read_preview(f: h5py.File, path: str, display_size: int, frames=slice(None)) -> Tuple[np.ndarray, int]:
+    """
+    Reads frames of a dataset at the lowest resolution that still fills display_size pixels, see preview_dataset.
+
+    Args:
+    - f (h5py.File): Opened stack file.
+    - path (str): Path of the full resolution dataset, e.g. '/registered/line_intensities/Mn_Ka'.
+    - display_size (int): Requested number of pixels along the larger side of a frame.
+    - frames: Frames to read (int, slice or list). Default all frames.
+
+    Returns:
+    - (np.ndarray, int): The frames and the downsampling factor.
+    """
+    ds, factor = preview_dataset(f, path, display_size)
+    return ds[frames], factor
+
+
+# attribute of /registered with the unix time at which write_registered_stack finished. Unlike the modification time
+# of the file, it does not change when other results (clustering, features, caches) are written to the stack file
+REGISTRATION_STAMP = 'registered_at'
+
+
+def registration_stamp(f: h5py.File) -> Optional[float]:
+    """Unix time at which the registered datasets of a stack file were written, or None for files registered before the stamp existed"""
+    if '/registered' not in f or REGISTRATION_STAMP not in f['/registered'].attrs:
+        return None
+    return float(f['/registered'].attrs[REGISTRATION_STAMP])
+
+
+def registration_state(f: h5py.File) -> Optional[str]:
+    """
+    How a stack file is registered: 'materialised' if the registered datasets were written to it, 'transforms' if only the
+    transforms were stored (register_stacks with materialise=False, read the frames with registered_stack.RegisteredStack),
+    or None if it is not registered.
+    """
+    if '/registered/line_intensities' in f:
+        return 'materialised'
+    if '/registered/transforms' in f:
+        return 'transforms'
+    return None
+
+
+TIME_MAJOR_GROUP = '/time_major'
+TIME_MAJOR_TILE = 32
+
+
+def time_major_path(path: str) -> str:
+    return f"{TIME_MAJOR_GROUP}/{path.strip('/')}"
+
+
+def write_time_major(f: h5py.File, group: str = 'registered', tile: int = TIME_MAJOR_TILE) -> List[str]:
+    """
+    Writes time-major copies, chunked as (all frames, tile, tile), of all (frames, rows, cols) datasets in a group of a stack file.
+    The copy is built out of core, one band of tile rows at a time, so every output chunk is written exactly once
+    and memory use is frames x tile x cols.
+
+    Args:
+    - f (h5py.File): Stack file opened in r+ mode.
+    - group (str): Group to copy. Default 'registered'.
+    - tile (int): Rows and columns of a chunk. Default 32.
+
+    Returns:
+    - List[str]: Paths of the copied datasets.
+    """
+    paths = []
+    def collect(name, obj):
+        if isinstance(obj, h5py.Dataset) and obj.ndim == 3 and name.split('/')[-1] not in PYRAMID_EXCLUDE:
+            paths.append(obj.name)
+    f[group].visititems(collect)
+    for path in paths:
+        ds = f[path]
+        n_frames, rows, cols = ds.shape
+        out_path = time_major_path(path)
+        if out_path in f:
+            del f[out_path]
+        out = f.create_dataset(out_path, shape=ds.shape, dtype=ds.dtype, chunks=(n_frames, min(tile, rows), min(tile, cols)),
+                               fillvalue=np.nan if np.issubdtype(ds.dtype, np.floating) else 0)
+        out.attrs.update(ds.attrs)
+        out.attrs['source'] = path
+        for band in row_blocks(rows, tile):
+            out[:, band, :] = ds[:, band, :]
+    return paths
+
+
+def remove_time_major(f: h5py.File, group: str = 'registered') -> None:
+    """Removes the time-major copies of a group, e.g. when its datasets are rewritten and the copies would be outdated"""
+    path = time_major_path(group)
+    if path in f:
+        del f[path]
+
+
+def chunks_touched(ds: h5py.Dataset, selection: Tuple[slice, ...]) -> int:
+    """Number of chunks of a dataset that a selection of slices touches. A contiguous dataset counts as one chunk per frame and row"""
+    chunks = ds.chunks if ds.chunks is not None else (1, 1, ds.shape[2])
+    n = 1
+    for sel, size, chunk in zip(selection, ds.shape, chunks):
+        start, stop, _ = sel.indices(size)
+        if stop <= start:
+            return 0
+        n *= (stop - 1)//chunk - start//chunk + 1
+    return n
+
+
+def stack_layout(f: h5py.File, path: str, selection: Tuple[slice, ...]) -> h5py.Dataset:
+    """Returns the dataset at path or its time-major copy, whichever touches fewer chunks for the selection"""
+    ds = f[path]
+    copy_path = time_major_path(path)
+    if copy_path in f and chunks_touched(f[copy_path], selection) < chunks_touched(ds, selection):
+        return f[copy_path]
+    return ds
+
+
+def read_stack(f: h5py.File, path: str, frames: slice = slice(None), rows: slice = slice(None), cols: slice = slice(None)) -> np.ndarray:
+    """
+    Reads a (frames, rows, cols) region of a stack from the layout that matches the query: the frame-major dataset for
+    whole frames, or its time-major copy (if written) for the time series of pixels and regions.
+
+    Args:
+    - f (h5py.File): Opened stack file.
+    - path (str): Path of the dataset, e.g. '/registered/line_intensities/Mn_Ka'.
+    - frames, rows, cols (slice): Region to read. Default everything.
+
+    Returns:
+    - np.ndarray: The region, shape (frames, rows, cols).
+    """
+    selection = (frames, rows, cols)
+    return stack_layout(f, path, selection)[selection]
@@ -0,0 +1,99 @@
+#
+# Prefetching reader of many stacks, for notebooks and analysis scripts that loop over all stacks of a query.
+#
+# iter_stacks() looks up the stacks in the Mongo 'stacks' collection and yields (doc, datasets) per stack, where datasets maps
+# each requested path (e.g. 'registered/line_intensities/Mn_Ka') to its data as a numpy array.
+# While the caller processes one stack, a background thread reads the datasets of the next stacks, so reading and
+# processing overlap instead of taking turns. At most prefetch stacks are read ahead, and optionally their total size
+# is limited to max_bytes, so memory use stays bounded however many stacks match.
+# Usage:
+#   for doc, data in iter_stacks({'beamline': 'P06', 'scan_type': 'roi'}, ['registered/line_intensities/Mn_Ka']):
+#       analyse(data['registered/line_intensities/Mn_Ka'])
+# iter_stacks()
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+import numpy as np
+import pymongo
+from typing import Dict, Iterator, List, Tuple
+
+
+def find_stacks(query : dict) -> List[dict]:
+    """Returns the documents of the stacks matching a Mongo query on the 'stacks' collection"""
+    client = pymongo.MongoClient('mongodb://localhost/')
+    db = client['in_situ_fluo']
+    stack_coll = db['stacks']
+    try:
+        return list(stack_coll.find(query))
+    finally:
+        client.close()
+
+
+def stack_nbytes(file_path : str, paths : List[str]) -> int:
+    """Size in bytes of the datasets of a stack file (0 for missing datasets), read from the metadata only"""
+    with h5py.File(file_path, 'r') as f:
+        return sum(f[path].size*f[path].dtype.itemsize for path in paths if path in f)
+
+
+def read_stack_datasets(file_path : str, paths : List[str]) -> Dict[str, np.ndarray]:
+    """Reads whole datasets of a stack file into memory"""
+    with h5py.File(file_path, 'r') as f:
+        return {path: f[path][()] for path in paths}
+
+
+def iter_stacks(query : dict, paths : List[str], prefetch : int = 1, max_bytes : int = None) -> Iterator[Tuple[dict, Dict[str, np.ndarray]]]:
+    """
+    Yields the documents and datasets of all stacks matching a query, reading the next stacks in a background thread.
+
+    Args:
+    - query (dict) : Mongo query on the 'stacks' collection, e.g. {'beamline': 'P06', 'sample_name': 'AlMnCrZr'}
+    - paths (List[str]) : datasets to read from every stack file, e.g. ['registered/line_intensities/Mn_Ka', 'registered/unix_time']
+    - prefetch (int) : number of stacks read ahead of the one being processed. Default 1
+    - max_bytes (int, optional) : limit on the total size of the stacks read ahead. A stack is always read if nothing else is
+        pending, so a single stack larger than max_bytes is still processed. Default no limit
+
+    Yields:
+    - doc (dict) : document of the stack
+    - datasets (Dict[str, np.ndarray]) : data of every path
+
+    Stacks whose file or datasets cannot be read are skipped with a message.
+    One reading thread is used, since h5py serialises all HDF5 calls of a process anyway.
+    """
+    docs = find_stacks(query)
+    t0 = time.time()
+    wait = 0
+    n_read = 0
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending = deque() # (doc, future, nbytes) in order
+    next_doc = 0
+    try:
+        while pending or next_doc < len(docs):
+            # fill the prefetch queue; the first pending stack is the one yielded next
+            while next_doc < len(docs) and len(pending) < prefetch + 1:
+                doc = docs[next_doc]
+                try:
+                    nbytes = stack_nbytes(doc['file_path'], paths)
+                except OSError:
+                    nbytes = 0 # reported when read
+                if pending and max_bytes is not None and sum(p[2] for p in pending) + nbytes > max_bytes:
+                    break
+                pending.append((doc, executor.submit(read_stack_datasets, doc['file_path'], paths), nbytes))
+                next_doc += 1
+
+            doc, future, _ = pending.popleft()
+            t_wait = time.time()
+            try:
+                datasets = future.result()
+            except (OSError, KeyError) as e:
+                print(f"Skipping {doc['file_path']}: {e!r}")
+                continue
+            finally:
+                wait += time.time() - t_wait
+            n_read += 1
+            yield doc, datasets
+    finally:
+        for _, future, _ in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        print(f'Read {n_read} of {len(docs)} stacks in {time.time() - t0:.1f} s, {wait:.1f} s waiting for reads')
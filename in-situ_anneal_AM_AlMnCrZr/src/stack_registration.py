@@ -11,9 +11,19 @@
 # (2)   Using feature detection with openCV ORB detection. This is usually a rough registration. 
 #       The transform found by this method is therefore fed as an initial guess to (1)
 #       If (1) still fails when being fed with the transform from (2) the script does not align the stack and prints an error.
-# TODO Finally, the transformations are applied to the datasets unix_times, positions_slow and positions_fast
+# With method='pyramid', (1) is first run on downsampled images and refined up to full resolution (find_one_transform_pyramid),
+# which handles larger drifts without falling back to (2).
+# With prealign=True, (1) is seeded with translations estimated for all frames at once by FFT phase correlation (phase_correlation_shifts),
+# and method='phase' uses only these translations as a fast translation-only registration.
+# Finally, the transformations are applied to all elements and to the datasets unix_time, positions_slow and positions_fast
 
 import cv2
+import os
+import time
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict
 import pymongo
 import h5py
@@ -21,6 +31,7 @@ import matplotlib.pyplot as plt
 
 from PIL import Image
 import numpy as np
+from stack_io import read_valid_extents, crop_to_extents, common_extent, nan_crop_box, write_pyramids, write_time_major, remove_time_major, PYRAMID_GROUP, REGISTRATION_STAMP
 def preprocess(img, vmin=None, vmax=None): 
     img = img.copy()
     if (vmin is not None) and (vmax is not None):
@@ -93,14 +104,63 @@ def crop_nans(stack: np.ndarray) -> np.ndarray:
         return stack
 
 
+PREPROCESS_BLOCK_BYTES = 1 << 20 # frames are scaled in blocks of about this size, so that the passes over a block stay in the CPU cache
+
+
+def preprocess_stack(stack : np.ndarray, vmin=None, vmax=None, l : float = 2, block_bytes : int = PREPROCESS_BLOCK_BYTES) -> np.ndarray:
+    """Stack version of preprocess: scales all frames of a (frames, rows, cols) stack to uint8.
+    Each frame is clipped to [vmin, vmax], or to mean +- l*std of the frame if they are not given, 
+    shifted to start at 0 and scaled to 0-255. The statistics of a block of frames are calculated in one batched call,
+    and clipping and scaling are done in place in one float copy of the block, written straight into the uint8 output.
+    
+    Args:
+    - stack (np.ndarray) : stack of frames without NaN values
+    - vmin, vmax : optional, minimum and maximum values for the scaling, the same for all frames
+    - l (float) : number of standard deviations to keep around the mean when vmin and vmax are not given. Default 2
+    - block_bytes (int) : approximate size of the float copy of a block of frames. Default PREPROCESS_BLOCK_BYTES
+    
+    Returns:
+    - scaled (np.ndarray) : uint8 stack of the same shape
+    """
+    dtype = np.result_type(stack.dtype, np.float32)
+    n_frames, rows, cols = stack.shape
+    block = max(1, block_bytes//(rows*cols*dtype.itemsize))
+    scaled = np.empty(stack.shape, dtype=np.uint8)
+    for start in range(0, n_frames, block):
+        frames = stack[start:start + block]
+        if (vmin is not None) and (vmax is not None):
+            out = np.subtract(frames, vmin, dtype=dtype)
+            np.clip(out, 0, vmax - vmin, out=out)
+        else:
+            # clipping the mean subtracted frames to +- l*std gives the same result after shifting to start at 0,
+            # and the std follows from the sum of squares without another temporary array
+            mu = frames.mean(axis=(1, 2), keepdims=True, dtype=dtype)
+            out = np.subtract(frames, mu, dtype=dtype)
+            std = np.sqrt(np.einsum('ijk,ijk->i', out, out)/(rows*cols))[:, None, None]
+            np.clip(out, -l*std, l*std, out=out)
+            out -= out.min(axis=(1, 2), keepdims=True)
+        out *= 255/out.max(axis=(1, 2), keepdims=True)
+        np.rint(out, out=out)
+        scaled[start:start + block] = out
+    return scaled
+
+
+def crop_nans_stack(stack : np.ndarray) -> np.ndarray:
+    """Stack version of crop_nans: crops all frames to the region that is valid in all of them.
+    The bounding boxes come from np.any reductions along each axis (stack_io.nan_crop_box) instead of np.argwhere per frame,
+    and the cropped stack is a view of the input.
+    """
+    rows, cols = nan_crop_box(stack)
+    return stack[:, rows, cols]
+
+
 def ORB_align(prev_frame, frame, vmin=None, vmax=None):
     MAX_FEATURES = 1000
     
     # Detect ORB features and compute descriptors.
     orb = cv2.ORB_create(nfeatures=MAX_FEATURES, patchSize=50)
 
-    prev_frame = preprocess(prev_frame, vmin, vmax)
-    frame = preprocess(frame, vmin, vmax)
+    prev_frame, frame = preprocess_stack(np.stack((prev_frame, frame), axis=0), vmin, vmax)
     mask = np.ones(shape=frame.shape, dtype=np.uint8)
     keypoints1, descriptors1 = orb.detectAndCompute(prev_frame, mask)
     keypoints2, descriptors2 = orb.detectAndCompute(frame, mask)
@@ -133,7 +193,7 @@ def ORB_align(prev_frame, frame, vmin=None, vmax=None):
 
 
 
-def find_one_transform(prev_frame, frame, vmin=None,vmax=None, initial_transform=None ):
+def find_one_transform(prev_frame, frame, vmin=None,vmax=None, initial_transform=None, return_ecc=False, show_failure=True):
     '''Transforms frame to align with prev_frame using translation, scale and rotation
     First uses the intensity based Enhanced Correlation Coefficient (ECC) from opencv to find transformation matrix
     For large shifts, ECC may fail. If it does not converge an initial guess of the transformation is therefore calculated first.
@@ -146,9 +206,12 @@ def find_one_transform(prev_frame, frame, vmin=None,vmax=None, initial_transform
     mask: any areas that should not be considered as a mask of 1's and 0's
     initial_orb: Indicate if the initial transform should be calculated based on ORB feature matching first. Default False
     initial_guess: transform matrix as optional initial guess. Default None
+    return_ecc: also return the ECC value (correlation coefficient) of the final transform. Default False
+    show_failure: show the two frames in a matplotlib figure if both ECC and ORB fail. Set to False in batch runs. Default True
     returns:
     - aligned_frame: frame shifted to align with prev_frame
-    - transform: matrix used to align frame to prev_frame'''
+    - transform: matrix used to align frame to prev_frame
+    - ecc: only if return_ecc is True'''
    
     
     if np.isnan(frame).any() or  np.isnan(prev_frame).any():
@@ -166,7 +229,7 @@ def find_one_transform(prev_frame, frame, vmin=None,vmax=None, initial_transform
     try:
         
         retval, transform = cv2.findTransformECC(prev_frame, frame, initial_transform, cv2.MOTION_EUCLIDEAN)
-        return transform
+        return (transform, retval) if return_ecc else transform
 
    
     except Exception as e:
@@ -180,7 +243,7 @@ def find_one_transform(prev_frame, frame, vmin=None,vmax=None, initial_transform
             print("ORB feature detection success. Will be used as initialisation matrix. Rerunning ECC")
             try:
                 retval, transform = cv2.findTransformECC(prev_frame, frame, transform, cv2.MOTION_EUCLIDEAN)
-                return transform
+                return (transform, retval) if return_ecc else transform
                
               
             except Exception as e:
@@ -190,76 +253,581 @@ def find_one_transform(prev_frame, frame, vmin=None,vmax=None, initial_transform
                     
         except Exception as e:
             print(e) 
-            
-            fig = plt.figure()
-            axs = fig.subplots(1,2)
-            axs[0].imshow(prev_frame)
-            axs[1].imshow(frame)
-            fig.show()
+            if show_failure:
+                fig = plt.figure()
+                axs = fig.subplots(1,2)
+                axs[0].imshow(prev_frame)
+                axs[1].imshow(frame)
+                fig.show()
             raise Exception
-def find_transforms(stack):
-    """
-   
+PYRAMID_LEVELS = 3
+PYRAMID_ITERATIONS = (100, 50, 20) # maximum number of ECC iterations per level, from the coarsest to the finest level
+PYRAMID_EPS = 1e-3
+PYRAMID_MIN_SIZE = 32 # levels smaller than this (in pixels) are not used
+
+
+def find_one_transform_pyramid(prev_frame, frame, levels=PYRAMID_LEVELS, iterations=PYRAMID_ITERATIONS, eps=PYRAMID_EPS, initial_transform=None, stats=None, return_ecc=False, show_failure=True):
+    """Coarse-to-fine version of find_one_transform.
+    The Euclidean transform is first estimated by ECC on downsampled (cv2.pyrDown) versions of the frames, and each estimate is used as the 
+    initial guess at the next finer level. Large shifts are found at the coarse levels where they are only a few pixels, 
+    so fewer iterations are needed at full resolution and the ORB fallback is rarely needed.
+    A level where ECC fails keeps the estimate of the previous level (findTransformECC overwrites its input matrix, so it is given a copy).
+    If ECC fails at full resolution, falls back to find_one_transform, seeded with the best estimate so far.
+    
+    Args:
+    - prev_frame : image to align to
+    - frame : image that should be aligned
+    - levels (int) : number of pyramid levels, including full resolution. Default 3
+    - iterations (tuple) : maximum number of ECC iterations at each level, from the coarsest to the finest
+    - eps (float) : ECC convergence threshold
+    - initial_transform : transform matrix (at full resolution) as optional initial guess. Default None
+    - stats (list) : optional list that a dict per level is appended to, with the level shape, maximum iterations,
+        ECC value, whether it converged and the time spent (openCV does not report the number of iterations used),
+        and whether the pair fell back to find_one_transform (see pyramid_fallbacks)
+    - return_ecc (bool) : also return the ECC value at full resolution. Default False
+    - show_failure (bool) : passed to find_one_transform when falling back to it
     returns:
-    - transforms (List[np.ndarray]) : list of transforms"""
-   
+    - transform : matrix used to align frame to prev_frame
+    - ecc : only if return_ecc is True
+    """
+    if np.isnan(frame).any() or  np.isnan(prev_frame).any():
+        print('Arrays contains nans, aborting')
+        raise ValueError
+    pyramid_prev = [prev_frame.astype(np.float32)]
+    pyramid_frame = [frame.astype(np.float32)]
+    while len(pyramid_prev) < levels and min(pyramid_prev[-1].shape) >= 2*PYRAMID_MIN_SIZE:
+        pyramid_prev.append(cv2.pyrDown(pyramid_prev[-1]))
+        pyramid_frame.append(cv2.pyrDown(pyramid_frame[-1]))
+    n_levels = len(pyramid_prev)
+    # use the iteration counts of the finest levels if fewer levels fit
+    iterations = list(iterations)[-n_levels:]
+
+    if initial_transform is None:
+        initial_transform = np.eye(2, 3, dtype=np.float32)
+    transform = initial_transform.astype(np.float32).copy()
+    scale = 2**(n_levels - 1)
+    transform[:, 2] /= scale
+
+    for level in range(n_levels - 1, -1, -1):
+        max_iterations = iterations[n_levels - 1 - level]
+        criteria = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, max_iterations, eps)
+        t0 = time.perf_counter()
+        try:
+            # the downsampled levels are already low-pass filtered by pyrDown, smoothing them again washes out the little texture left
+            gauss_size = 5 if level == 0 else 1
+            retval, estimate = cv2.findTransformECC(pyramid_prev[level], pyramid_frame[level], transform.copy(), cv2.MOTION_EUCLIDEAN, criteria, None, gauss_size)
+            transform = estimate
+            converged = True
+        except cv2.error as e:
+            retval, converged = np.nan, False
+        if stats is not None:
+            stats.append({'level': level, 'shape': list(pyramid_prev[level].shape), 'max_iterations': max_iterations,
+                          'ecc': float(retval), 'converged': converged, 'fallback': level == 0 and not converged,
+                          'time_s': time.perf_counter() - t0})
+        if level > 0:
+            transform[:, 2] *= 2
+    if not converged:
+        print("ECC algorithm failed to converge at full resolution of the pyramid. Falling back to the full resolution registration")
+        return find_one_transform(prev_frame, frame, initial_transform=transform, return_ecc=return_ecc, show_failure=show_failure)
+    return (transform, retval) if return_ecc else transform
+
+
+def pyramid_fallbacks(stats : List[dict]) -> int:
+    """Number of pairs in the pyramid statistics of find_transforms that fell back to the full resolution find_one_transform"""
+    return sum(any(level.get('fallback', False) for level in pair['levels']) for pair in stats)
+
+
+def _parabolic_offset(c_minus, c_0, c_plus):
+    """Sub-pixel offset of a peak from a parabola through the peak value and its two neighbours"""
+    denom = c_minus - 2*c_0 + c_plus
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(np.abs(denom) > 1e-12, 0.5*(c_minus - c_plus)/denom, 0.0)
+    return np.clip(offset, -0.5, 0.5)
+
+
+def phase_correlation_shifts(stack : np.ndarray, window : bool = True, batch_size : int = 64) -> np.ndarray:
+    """Estimates the translation between all subsequent frames of a stack by phase correlation.
+    The frames are windowed and transformed with batched real FFTs along the frame axis, and the peak
+    of each cross-power spectrum is refined to sub-pixel precision with a parabolic fit.
+    
+    Args:
+    - stack (np.ndarray) : stack of frames without NaN values, shape (frames, rows, cols)
+    - window (bool) : apply a Hann window before the FFT to suppress edge effects. Default True
+    - batch_size (int) : number of frames transformed at once, limits the memory use. Default 64
+    
+    Returns:
+    - shifts (np.ndarray) : (n_frames, 2) array of (x, y) shifts of frame i relative to frame i-1, the first row is 0.
+        The shifts are in the convention of the translation part of the transforms from find_one_transform.
+    """
+    n_frames, rows, cols = stack.shape
+    shifts = np.zeros((n_frames, 2), dtype=np.float64)
+    if window:
+        hann = np.outer(np.hanning(rows), np.hanning(cols)).astype(np.float32)
+    last_spectrum = None
+    for start in range(0, n_frames, batch_size):
+        frames = stack[start:start + batch_size].astype(np.float32) # copy, modified in place below
+        frames -= frames.mean(axis=(1, 2), keepdims=True)
+        if window:
+            frames *= hann
+        spectra = np.fft.rfft2(frames, axes=(1, 2))
+        # pair every frame in the batch with its previous frame, which for the first one is the last frame of the previous batch
+        if last_spectrum is None:
+            spectra_prev, spectra_next, first = spectra[:-1], spectra[1:], start + 1
+        else:
+            spectra_prev, spectra_next, first = np.concatenate((last_spectrum[None], spectra[:-1]), axis=0), spectra, start
+        last_spectrum = spectra[-1]
+        if len(spectra_next) == 0:
+            continue
+        cross_power = spectra_next*np.conj(spectra_prev)
+        cross_power /= np.abs(cross_power) + 1e-12
+        correlation = np.fft.irfft2(cross_power, s=(rows, cols), axes=(1, 2))
+
+        peak_rows, peak_cols = np.unravel_index(correlation.reshape(len(correlation), -1).argmax(axis=1), (rows, cols))
+        idx = np.arange(len(correlation))
+        peak = correlation[idx, peak_rows, peak_cols]
+        d_row = _parabolic_offset(correlation[idx, (peak_rows - 1) % rows, peak_cols], peak, correlation[idx, (peak_rows + 1) % rows, peak_cols])
+        d_col = _parabolic_offset(correlation[idx, peak_rows, (peak_cols - 1) % cols], peak, correlation[idx, peak_rows, (peak_cols + 1) % cols])
+        # peaks in the upper half of the correlation correspond to negative shifts
+        shifts[first:first + len(correlation), 0] = np.where(peak_cols > cols//2, peak_cols - cols, peak_cols) + d_col
+        shifts[first:first + len(correlation), 1] = np.where(peak_rows > rows//2, peak_rows - rows, peak_rows) + d_row
+    return shifts
+
+
+def translation_transforms(shifts : np.ndarray) -> List[np.ndarray]:
+    """Converts (x, y) shifts from phase_correlation_shifts into a list of 2x3 translation transforms"""
     transforms = []
-    prev_frame = None
-   
-    for i, frame in enumerate(stack):
-            
-        if prev_frame is None:
-            # If this is the first frame, set it as the previous frame 
-            prev_frame = frame
-            #append a transform that does nothing when applied
-            transforms.append(np.eye(2, 3, dtype=np.float32))
-        
+    for dx, dy in shifts:
+        transform = np.eye(2, 3, dtype=np.float32)
+        transform[:, 2] = (dx, dy)
+        transforms.append(transform)
+    return transforms
+
+
+def _find_one_transform(prev_frame, frame, method='ecc', stats=None, initial_transform=None, show_failure=True):
+    """Returns the transform and its ECC value"""
+    if method == 'pyramid':
+        return find_one_transform_pyramid(prev_frame, frame, initial_transform=initial_transform, stats=stats, return_ecc=True, show_failure=show_failure)
+    elif method == 'ecc':
+        return find_one_transform(prev_frame, frame, initial_transform=initial_transform, return_ecc=True, show_failure=show_failure)
+    else:
+        raise ValueError(f'Unknown registration method {method}')
+
+
+class TransformCache:
+    """
+    Persistent cache of the transforms between pairs of frames, stored in the stack file.
+    Each pair is identified by the scan numbers of the two frames. Transforms calculated with different
+    parameters (reference element, method, preprocessing etc., see registration_cache_params) are stored in separate groups
+    under /registration_cache, named by a hash of the parameters, so changing a parameter invalidates all pairs.
+    The crop box the frames were cut to is stored with every pair instead of in the parameters, since it is common to all frames
+    and shrinks when a scan with a smaller extent is appended. A cached pair is reused as long as the current crop box lies inside
+    its own, with the transform moved to the origin of the current crop box.
+    Every transform is written to the file as soon as it is added, so a registration that fails at frame i
+    can be resumed from frame i.
+
+    Attributes:
+        group (h5py.Group): Group holding the datasets 'scan_pairs', 'transforms', 'ecc' and 'crops'.
+        scan_numbers (List[int]): Scan number of each frame in the stack.
+        min_ecc (float): Cached transforms with a lower ECC value are treated as missing.
+        crop (np.ndarray): [row start, row stop, col start, col stop] of the crop box of the frames.
+
+    Parameters:
+        f (h5py.File): Stack file opened in r+ mode.
+        params (dict): All parameters that affect the transforms, except the crop box. Must be JSON serialisable.
+        crop (tuple): (rows, cols) slices of the crop box, see crop_box.
+        min_ecc (float, optional): Cached transforms with a lower ECC value are recalculated. Defaults to None.
+    """
+    def __init__(self, f : h5py.File, params : dict, crop : tuple, min_ecc : float = None):
+        self.scan_numbers = [int(n) for n in f['scan_numbers'][()]]
+        self.min_ecc = min_ecc
+        rows, cols = crop
+        self.crop = np.array([rows.start, rows.stop, cols.start, cols.stop], dtype=np.int64)
+        params_json = json.dumps(params, sort_keys=True)
+        key = hashlib.sha1(params_json.encode()).hexdigest()[:16]
+        cache_g = f.require_group('/registration_cache')
+        if key not in cache_g:
+            group = cache_g.create_group(key)
+            group.attrs['params'] = params_json
+            group.create_dataset('scan_pairs', shape=(0, 2), maxshape=(None, 2), dtype=np.int64, chunks=(256, 2))
+            group.create_dataset('transforms', shape=(0, 2, 3), maxshape=(None, 2, 3), dtype=np.float32, chunks=(256, 2, 3))
+            group.create_dataset('ecc', shape=(0,), maxshape=(None,), dtype=np.float64, chunks=(256,))
+            group.create_dataset('crops', shape=(0, 4), maxshape=(None, 4), dtype=np.int64, chunks=(256, 4))
+        self.group = cache_g[key]
+        self._index = {tuple(pair): row for row, pair in enumerate(self.group['scan_pairs'][()].tolist())}
+
+    def _pair(self, i : int, j : int = None) -> tuple:
+        if j is None:
+            j = i - 1
+        return (self.scan_numbers[j], self.scan_numbers[i])
+
+    def get(self, i : int, j : int = None):
+        """Returns the cached (transform, ecc) between frames j (default i-1) and i, or None if it is missing, invalid
+        or was calculated on a crop box that does not contain the current one"""
+        row = self._index.get(self._pair(i, j))
+        if row is None:
+            return None
+        ecc = self.group['ecc'][row]
+        if self.min_ecc is not None and not ecc >= self.min_ecc:
+            return None
+        crop = self.group['crops'][row]
+        if not (crop[0] <= self.crop[0] and self.crop[1] <= crop[1] and crop[2] <= self.crop[2] and self.crop[3] <= crop[3]):
+            return None
+        transform = self.group['transforms'][row]
+        # x' = A x + t in the cached crop box is x' = A x + (A d + t - d) in the current one, d its origin in the cached one (x, y order)
+        d = np.array([self.crop[2] - crop[2], self.crop[0] - crop[0]], dtype=np.float32)
+        transform[:, 2] += transform[:, :2] @ d - d
+        return transform, ecc
+
+    def put(self, i : int, transform : np.ndarray, ecc : float, j : int = None) -> None:
+        """Stores the transform between frames j (default i-1) and i, replacing any previous value"""
+        pair = self._pair(i, j)
+        row = self._index.get(pair)
+        if row is None:
+            row = self.group['scan_pairs'].shape[0]
+            for name in ['scan_pairs', 'transforms', 'ecc', 'crops']:
+                self.group[name].resize(row + 1, axis=0)
+            self.group['scan_pairs'][row] = pair
+            self._index[pair] = row
+        self.group['transforms'][row] = transform
+        self.group['ecc'][row] = ecc
+        self.group['crops'][row] = self.crop
+        self.group.file.flush()
+
+
+FAILURE_POLICIES = ['abort', 'identity', 'skip']
+
+
+def save_failure_diagnostics(prev_frame : np.ndarray, frame : np.ndarray, path : str, title : str = '') -> None:
+    """Saves the two frames of a failed pair side by side as a PNG. Uses the Agg canvas directly, so no interactive backend is touched"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(10, 5))
+    FigureCanvasAgg(fig)
+    axs = fig.subplots(1, 2)
+    axs[0].imshow(prev_frame)
+    axs[0].set_title('reference')
+    axs[1].imshow(frame)
+    axs[1].set_title('frame')
+    fig.suptitle(title)
+    fig.savefig(path, dpi=100)
+
+
+def find_transforms(stack, parallel=False, n_workers=None, cv_threads=1, method='ecc', stats=None, prealign=False, cache=None,
+                    on_failure='abort', show_failure=True, diagnostics_dir=None, report=None):
+    """
+    Finds the transforms between all subsequent frames in the stack.
+    Each pair of frames only depends on the two frames, so with parallel=True all pairs are
+    registered in a pool of worker processes (including the ORB fallback) and the transforms are reassembled in order.
+    Args:
+    - stack (np.ndarray) : stack of frames without NaN values
+    - parallel (bool) : register the pairs of frames in parallel. Default False
+    - n_workers (int) : number of worker processes when parallel. Default is the number of cores
+    - cv_threads (int) : number of threads openCV may use in each worker process. Default 1, so that workers do not oversubscribe the cores
+    - method (str) : 'ecc' for find_one_transform, 'pyramid' for find_one_transform_pyramid, 
+        or 'phase' for translation only registration by phase correlation (phase_correlation_shifts). Default 'ecc'
+    - stats (list) : optional list that the per level statistics of each pair are appended to, when method is 'pyramid'
+    - prealign (bool) : seed ECC with the translations from phase_correlation_shifts instead of the identity matrix. Default False
+    - cache (TransformCache) : optional persistent cache. Pairs found in it are not recalculated, and new pairs are added to it
+    - on_failure (str) : what to do when a pair of frames can not be registered. 
+        'abort' raises a RuntimeError (default), 'identity' uses the identity transform for the pair,
+        'skip' leaves the frame out (its transform is the identity, and the next frame is registered to the last good frame)
+    - show_failure (bool) : show failed pairs in an interactive matplotlib figure. Default True, never done in worker processes
+    - diagnostics_dir (str) : if given, a PNG of each failed pair is saved here
+    - report (list) : optional list that a dict per pair is appended to, with the frame indices, ECC value, status and error
+    returns:
+    - transforms (List[np.ndarray]) : list of transforms. Frames skipped with on_failure='skip' are listed in the report"""
+    if on_failure not in FAILURE_POLICIES:
+        raise ValueError(f'on_failure must be one of {FAILURE_POLICIES}')
+    if method == 'phase':
+        return translation_transforms(phase_correlation_shifts(stack))
+    shifts = phase_correlation_shifts(stack) if prealign else None
+    def initial_transform(j, i):
+        # the translation between frame j and i is the sum of the translations between the frames in between
+        if shifts is None:
+            return None
+        return translation_transforms(shifts[j+1:i+1].sum(axis=0, keepdims=True))[0]
+
+    precomputed = {}
+    if parallel:
+        missing = [i for i in range(1, len(stack)) if cache is None or cache.get(i) is None]
+        precomputed = find_transforms_parallel(stack, missing, n_workers, cv_threads, method,
+                                               [initial_transform(i-1, i) for i in missing])
+
+    transforms = [np.eye(2, 3, dtype=np.float32)]
+    prev_idx = 0 # index of the frame that the next frame is registered to
+    for i in range(1, len(stack)):
+        cached = cache.get(i, prev_idx) if cache is not None else None
+        if cached is not None:
+            transforms.append(cached[0])
+            if report is not None:
+                report.append({'pair': [prev_idx, i], 'ecc': float(cached[1]), 'status': 'cached', 'error': None})
+            prev_idx = i
             continue
-        try:
-                
-            t = find_one_transform(prev_frame, frame)
-            transforms.append(t)
-        except:
-            print(f"Failed matching frames with position {i-1} and {i} in the stack ")
-            raise Exception
-        prev_frame = frame
+        if prev_idx == i - 1 and i in precomputed:
+            transform, ecc, pair_stats, error = precomputed[i]
+        else:
+            _, transform, ecc, pair_stats, error = _find_pair_transform((i, stack[prev_idx], stack[i], method, initial_transform(prev_idx, i), show_failure))
+        if stats is not None:
+            stats.append({'pair': [prev_idx, i], 'levels': pair_stats})
+
+        if error is None:
+            transforms.append(transform)
+            if cache is not None:
+                cache.put(i, transform, ecc, prev_idx)
+            if report is not None:
+                report.append({'pair': [prev_idx, i], 'ecc': float(ecc), 'status': 'ok', 'error': None})
+            prev_idx = i
+            continue
+
+        print(repr(error))
+        print(f"Failed matching frames with position {prev_idx} and {i} in the stack ")
+        if diagnostics_dir is not None:
+            save_failure_diagnostics(stack[prev_idx], stack[i], os.path.join(diagnostics_dir, f'failed_pair_{prev_idx}_{i}.png'),
+                                     f'frames {prev_idx} and {i}: {error!r}')
+        if report is not None:
+            report.append({'pair': [prev_idx, i], 'ecc': None, 'status': on_failure, 'error': repr(error)})
+        if on_failure == 'abort':
+            # with 'abort' every earlier pair succeeded, so prev_idx is i-1
+            raise RuntimeError(f'registration failed between frames {prev_idx} and {i}: {error}') from error
+        # both 'identity' and 'skip' give frame i the same transform as frame prev_idx.
+        # With 'skip' the following frame is registered to frame prev_idx instead of frame i
+        transforms.append(np.eye(2, 3, dtype=np.float32))
+        if on_failure == 'identity':
+            prev_idx = i
     
     return transforms
-                
-def apply_transforms(stack : np.ndarray, transforms : List[np.ndarray]) -> np.ndarray:
-    aligned_stack = []
-    stack = crop_nans(stack)
-    # Transforms in their current state describe the transformation between two subsequent images
-    # Convert all transforms so that they describe the transform with respect to the very first frame in the stack.
+
+
+def skipped_frames(report : List[dict]) -> List[int]:
+    """Frames that were left out of the registration with on_failure='skip', from the report of find_transforms"""
+    return [entry['pair'][1] for entry in report if entry['status'] == 'skip']
+
+
+def _init_registration_worker(cv_threads):
+    cv2.setNumThreads(cv_threads)
+
+
+def _find_pair_transform(pair):
+    i, prev_frame, frame, method, initial_transform, show_failure = pair
+    pair_stats = []
+    try:
+        transform, ecc = _find_one_transform(prev_frame, frame, method, pair_stats, initial_transform, show_failure)
+        return i, transform, ecc, pair_stats, None
+    except Exception as e:
+        return i, None, None, pair_stats, e
+
+
+def find_transforms_parallel(stack, indices, n_workers=None, cv_threads=1, method='ecc', initial_transforms=None) -> Dict[int, tuple]:
+    """
+    Registers the pairs of frames (i-1, i) for all i in indices in a process pool. Used by find_transforms(parallel=True).
     
-    for i in range(len(transforms)):
-       
-        
+    Args:
+    - stack (np.ndarray) : stack of frames without NaN values
+    - indices (List[int]) : index i of the second frame of each pair
+    - n_workers (int) : number of worker processes. Default is the number of cores
+    - cv_threads (int) : number of threads openCV may use in each worker process. Default 1
+    - method (str) : 'ecc' or 'pyramid', see find_transforms
+    - initial_transforms (list) : optional initial guess for each pair, e.g. from phase_correlation_shifts
+    returns:
+    - results (Dict[int, tuple]) : maps i to (transform, ecc, pyramid stats, error). transform is None and error the exception if the pair failed"""
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if initial_transforms is None:
+        initial_transforms = [None]*len(indices)
+    results = {}
+    if not indices:
+        return results
+    # figures can not be shown from worker processes
+    pairs = ((i, stack[i-1], stack[i], method, initial_transforms[n], False) for n, i in enumerate(indices))
+    # spawn instead of fork, openCV's internal thread pool is not safe to fork
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx, initializer=_init_registration_worker, initargs=(cv_threads,)) as executor:
+        for i, transform, ecc, pair_stats, error in executor.map(_find_pair_transform, pairs):
+            results[i] = (transform, ecc, pair_stats, error)
+    return results
+
+
+def cumulative_transforms(transforms : List[np.ndarray]) -> np.ndarray:
+    """Chains the transforms between subsequent frames into transforms of each frame with respect to the very first frame.
+    Transform i is T_i @ T_i-1 @ ... @ T_0, built from transform i-1 with a single matrix multiplication.
     
-        #flip the order of the transforms so that the matrix multiplication is correct
-        # last transform will come first
-        
-        ts = np.flip(transforms[0:i+1],axis=0)
-        #fix so that it has the correct shape
-        final_transform = np.vstack((ts[0], [0, 0, 1]))
-        # Chain all the transforms up until this frame i
-        for j in range(1,len(ts)):
-            final_transform = final_transform@np.vstack((ts[j], [0, 0, 1]))
-        #apply the chained transform to the current frame
-        frame = stack[i]
-        aligned_stack.append(cv2.warpAffine(frame, final_transform[0:2,:], (frame.shape[1], frame.shape[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP, borderValue=np.nan))
-    return np.stack(aligned_stack, axis=0)
-       
-       
+    Args:
+    - transforms (List[np.ndarray]) : list of 2x3 transforms between subsequent frames, as returned by find_transforms
+    
+    Returns:
+    - cumulative (np.ndarray) : (n_frames, 2, 3) array of transforms with respect to the first frame
+    """
+    cumulative = np.empty((len(transforms), 2, 3), dtype=np.float64)
+    chained = np.eye(3)
+    for i, transform in enumerate(transforms):
+        chained = np.vstack((transform, [0, 0, 1])) @ chained
+        cumulative[i] = chained[0:2, :]
+    return cumulative
+
+
+def warp_frame(frame : np.ndarray, transform : np.ndarray) -> np.ndarray:
+    return cv2.warpAffine(frame, transform, (frame.shape[1], frame.shape[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP, borderValue=np.nan)
 
+
+def warp_stack(stack : np.ndarray, cumulative : np.ndarray) -> np.ndarray:
+    """Applies the transforms with respect to the first frame (see cumulative_transforms) to a cropped stack"""
+    return np.stack([warp_frame(frame, transform) for frame, transform in zip(stack, cumulative)], axis=0)
+
+
+def apply_transforms(stack : np.ndarray, transforms : List[np.ndarray], extents : np.ndarray = None) -> np.ndarray:
+    # crop away the NaN padding. With the valid extents stored in the stack file this is a slice, otherwise NaNs are searched for
+    if extents is not None:
+        stack = crop_to_extents(stack, extents)
+    else:
+        stack = crop_nans_stack(stack)
+    # Transforms in their current state describe the transformation between two subsequent images
+    # Convert all transforms so that they describe the transform with respect to the very first frame in the stack.
+    return warp_stack(stack, cumulative_transforms(transforms))
+
+
+def save_transforms(f : h5py.File, cumulative : np.ndarray, ref_element : str, skipped : List[int] = None) -> None:
+    """Stores the transforms with respect to the first frame under /registered/transforms in an opened stack file.
+    Frames that could not be registered (find_transforms with on_failure='skip') are stored in the attribute skipped_frames."""
+    registered_g = f.require_group('/registered')
+    if 'transforms' in registered_g:
+        del registered_g['transforms']
+    ds = registered_g.create_dataset('transforms', data=cumulative)
+    ds.attrs['ref_element'] = ref_element
+    ds.attrs['description'] = 'Affine transforms (cv2.WARP_INVERSE_MAP) of each frame with respect to the first frame'
+    ds.attrs['skipped_frames'] = np.array(skipped if skipped is not None else [], dtype=np.int64)
+
+
+def load_transforms(f : h5py.File) -> (np.ndarray, str):
+    """Loads the transforms stored by save_transforms, and the element they were calculated from"""
+    ds = f['/registered/transforms']
+    return ds[()], ds.attrs['ref_element']
+
+
+def load_skipped_frames(f : h5py.File) -> List[int]:
+    """Loads the frames that were left out of the registration, see save_transforms"""
+    return [int(i) for i in f['/registered/transforms'].attrs.get('skipped_frames', [])]
+
+
+def crop_box(f : h5py.File, ref_element : str) -> (slice, slice):
+    """Returns the row and column slices of the region that is valid in all frames of the unregistered stack.
+    Uses the valid extents stored in the stack file if present, otherwise searches the reference element for NaN padding."""
+    extents = read_valid_extents(f)
+    if extents is not None:
+        rows, cols = common_extent(extents)
+        return slice(0, rows), slice(0, cols)
+    return nan_crop_box(f[f'/unregistered/line_intensities/{ref_element}'][()])
+
+
+def remap_grids(transform : np.ndarray, shape : tuple) -> (np.ndarray, np.ndarray):
+    """Source coordinates of every pixel for cv2.remap, equivalent to cv2.warpAffine with cv2.WARP_INVERSE_MAP"""
+    y, x = np.indices(shape, dtype=np.float32)
+    map_x = transform[0, 0]*x + transform[0, 1]*y + transform[0, 2]
+    map_y = transform[1, 0]*x + transform[1, 1]*y + transform[1, 2]
+    return map_x.astype(np.float32), map_y.astype(np.float32)
+
+
+def remap_channels(frames : List[np.ndarray], map_x : np.ndarray, map_y : np.ndarray, interpolation : int, dtype) -> np.ndarray:
+    """Warps several 2D frames of the same shape with a single cv2.remap call. Returns an array of shape (rows, cols, channels)"""
+    channels = np.stack(frames, axis=-1).astype(dtype, copy=False)
+    warped = cv2.remap(channels, map_x, map_y, interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=(np.nan,)*4)
+    return warped.reshape(channels.shape)
+
+
+def _create_frame_dataset(group : h5py.Group, name : str, shape : tuple, dtype, attrs : dict) -> h5py.Dataset:
+    if name in group:
+        del group[name]
+    ds = group.create_dataset(name, shape=shape, dtype=dtype, chunks=(1,) + shape[1:], fillvalue=np.nan)
+    ds.attrs.update(attrs)
+    return ds
+
+
+def write_registered_stack(f : h5py.File, cumulative : np.ndarray, ref_element : str) -> None:
+    """Applies the transforms to all elements under /unregistered/line_intensities, and to unix_time and positions,
+    and writes them under /registered with the same structure as /unregistered.
+    The remap grids are built once per frame, all elements are warped together in one cv2.remap call (bilinear)
+    and unix_time and positions together in another (nearest neighbour, so no times or positions are made up).
+    Data is read and written one frame at a time, so memory use is one frame times the number of channels.
+    Frames that were skipped during registration (see load_skipped_frames) are left as NaN.
+    Finally the pyramid previews and the time-major copies of the registered datasets are written
+    (stack_io.write_pyramids and stack_io.write_time_major), so pixel and region time series are read from one chunk per 32 x 32 pixels.
+    When everything is written, the time is stored in the /registered attribute registered_at (stack_io.registration_stamp),
+    which tells e.g. movie_maker.py whether its outputs are older than the registration.
     
+    Args:
+    - f (h5py.File) : stack file opened in r+ mode
+    - cumulative (np.ndarray) : (n_frames, 2, 3) transforms with respect to the first frame
+    - ref_element (str) : element the transforms were calculated from
+    """
+    rows, cols = crop_box(f, ref_element)
+    unregistered_g = f['/unregistered']
+    registered_g = f.require_group('/registered')
+    if REGISTRATION_STAMP in registered_g.attrs:
+        del registered_g.attrs[REGISTRATION_STAMP]
+    # the time-major copies of the previous registration would be preferred by stack_io.read_pixel_block if this one fails halfway
+    remove_time_major(f, 'registered')
+    n_frames = len(cumulative)
+    shape = (rows.stop - rows.start, cols.stop - cols.start)
 
-        
+    # bilinear channels: the elemental maps
+    elements = list(unregistered_g['line_intensities'])
+    element_datasets = [unregistered_g['line_intensities'][element] for element in elements]
+    element_dtype = np.result_type(np.float32, *[ds.dtype for ds in element_datasets])
+    registered_line_intensities_g = registered_g.require_group('line_intensities')
+    registered_elements = [_create_frame_dataset(registered_line_intensities_g, element, (n_frames,) + shape, element_dtype,
+                                                 {'units': 'a.u.', 'ref_element': ref_element}) for element in elements]
 
-def register_stacks(beamline : str = None, sample_name : str = None, scan_type : str = None) -> None:
-    client = pymongo.MongoClient('mongodb://localhost/')
-    db = client['in_situ_fluo']
-    stack_coll = db['stacks']
+    # nearest neighbour channels: pixel times and positions
+    aux_paths = [path for path in ['unix_time', 'positions/positions_fast', 'positions/positions_slow'] if path in unregistered_g]
+    aux_datasets = [unregistered_g[path] for path in aux_paths]
+    registered_aux = [_create_frame_dataset(registered_g, path, (n_frames,) + shape, np.float64,
+                                            {'units': ds.attrs.get('units', ''), 'ref_element': ref_element}) for path, ds in zip(aux_paths, aux_datasets)]
+
+    skipped = set(load_skipped_frames(f))
+    print(f'Applying tranforms to {len(elements)} elements and {len(aux_paths)} time and position datasets')
+    for i in range(n_frames):
+        if i in skipped:
+            continue
+        map_x, map_y = remap_grids(cumulative[i], shape)
+        if element_datasets:
+            warped = remap_channels([ds[i, rows, cols] for ds in element_datasets], map_x, map_y, cv2.INTER_LINEAR, element_dtype)
+            for c, ds in enumerate(registered_elements):
+                ds[i] = warped[..., c]
+        if aux_datasets:
+            warped = remap_channels([ds[i, rows, cols] for ds in aux_datasets], map_x, map_y, cv2.INTER_NEAREST, np.float64)
+            for c, ds in enumerate(registered_aux):
+                ds[i] = warped[..., c]
+    # downsampled previews of the registered datasets
+    write_pyramids(f, 'registered')
+    # time-major copies for pixel and region time series
+    write_time_major(f, 'registered')
+    registered_g.attrs[REGISTRATION_STAMP] = time.time()
+
+
+def remove_registered_datasets(f : h5py.File) -> None:
+    """
+    Removes the registered datasets of an earlier, materialised registration together with their previews and time-major copies,
+    leaving only /registered/transforms. Used when a stack is registered with materialise=False, so that readers do not
+    prefer the outdated datasets over the new transforms (see stack_io.registration_state).
+    The registration stamp is set to now, since the registered frames (read with registered_stack.RegisteredStack) changed.
+    """
+    registered_g = f.require_group('/registered')
+    remove_time_major(f, 'registered')
+    for name in ['line_intensities', 'unix_time', 'positions']:
+        if name in registered_g:
+            del registered_g[name]
+    if f'{PYRAMID_GROUP}/registered' in f:
+        del f[f'{PYRAMID_GROUP}/registered']
+    registered_g.attrs[REGISTRATION_STAMP] = time.time()
+
+
+def reapply_transforms(file_path : str) -> None:
+    """Re-applies the transforms stored in a stack file to all datasets, without recalculating them"""
+    with h5py.File(file_path, 'r+') as f:
+        cumulative, ref_element = load_transforms(f)
+        write_registered_stack(f, cumulative, ref_element)
+
+
+def _stack_query(beamline : str = None, sample_name : str = None, scan_type : str = None) -> dict:
     query = {}
     if beamline is not None:
         query['beamline'] = beamline
@@ -267,45 +835,127 @@ def register_stacks(beamline : str = None, sample_name : str = None, scan_type :
         query['sample_name'] = sample_name
     if scan_type is not None:
         query['scan_type'] = scan_type
+    return query
+
+
+def registration_cache_params(ref_element : str, method : str, prealign : bool) -> dict:
+    """Everything besides the two frames and the crop box that affects a pairwise transform, changing any of them invalidates the TransformCache"""
+    # the ORB fallback scales the frames to +- l std (preprocess_stack defaults)
+    params = {'ref_element': ref_element, 'method': method, 'prealign': prealign, 'preprocess': {'vmin': None, 'vmax': None, 'l': 2}}
+    if method == 'pyramid':
+        params['pyramid'] = {'levels': PYRAMID_LEVELS, 'iterations': list(PYRAMID_ITERATIONS), 'eps': PYRAMID_EPS, 'min_size': PYRAMID_MIN_SIZE}
+    return params
+
+
+def register_stack(doc : dict, ref_element : str = 'Mn_Ka', parallel : bool = False, n_workers : int = None, method : str = 'ecc', prealign : bool = False,
+                   materialise : bool = True, use_cache : bool = True, on_failure : str = 'abort', show_failure : bool = True, diagnostics_dir : str = None,
+                   report : List[dict] = None) -> List[dict]:
+    """Registers the stack of one document of the stacks collection, see register_stacks.
+    Returns the report of find_transforms, with one entry per pair of frames. 
+    If a report list is given it is filled in place, so it also holds the pairs done before an exception."""
+    if report is None:
+        report = []
+    with h5py.File(doc['file_path'], 'r+') as f:
+        rows, cols = crop_box(f, ref_element)
+        stack = f[f'/unregistered/line_intensities/{ref_element}'][:, rows, cols]
+        print('Calculating transforms')
+        cache = None
+        if use_cache:
+            cache = TransformCache(f, registration_cache_params(ref_element, method, prealign), (rows, cols))
+        stats = []
+        transforms = find_transforms(stack, parallel=parallel, n_workers=n_workers, method=method, stats=stats, prealign=prealign, cache=cache,
+                                     on_failure=on_failure, show_failure=show_failure, diagnostics_dir=diagnostics_dir, report=report)
+        print('Transforms calculated')
+
+        # chain the transforms once, they are the same for all elements
+        cumulative = cumulative_transforms(transforms)
+        save_transforms(f, cumulative, ref_element, skipped_frames(report))
+        f['/registered/transforms'].attrs['method'] = method
+        if method == 'pyramid':
+            f['/registered/transforms'].attrs['pyramid_stats'] = json.dumps(stats)
+        if materialise:
+            write_registered_stack(f, cumulative, ref_element)
+        else:
+            remove_registered_datasets(f)
+    return report
+
+
+def register_stacks(beamline : str = None, sample_name : str = None, scan_type : str = None, parallel : bool = False, n_workers : int = None, method : str = 'ecc', prealign : bool = False, materialise : bool = True, use_cache : bool = True,
+                    on_failure : str = 'abort', show_failure : bool = True) -> None:
+    """Registers all stacks in the stacks collection matching the query. The transforms are stored under /registered/transforms.
+    With use_cache=True the transforms between pairs of frames are cached in the stack file (see TransformCache), so only new or failed pairs are recalculated.
+    With materialise=True the registered datasets are also written to the stack file, otherwise they can be read on demand
+    with registered_stack.RegisteredStack.
+    on_failure decides what happens with pairs of frames that can not be registered, see find_transforms. 
+    A stack that fails is reported and the remaining stacks are still registered."""
+    client = pymongo.MongoClient('mongodb://localhost/')
+    db = client['in_situ_fluo']
+    stack_coll = db['stacks']
+    query = _stack_query(beamline, sample_name, scan_type)
 
     stack_docs = stack_coll.find(query)
-    ref_element = 'Mn_Ka'
     try:
         for doc in stack_docs:
             print('Registering ' + doc['beamline'] + " " + doc['sample_name'] + " " + doc['scan_type'])
-            with h5py.File(doc['file_path'], 'r') as f:
-                stack = f[f'/unregistered/line_intensities/{ref_element}'][()]
-                stack = crop_nans(stack)
-            
-            
-            
             try:
-                print('Calculating transforms')
-                transforms = find_transforms(stack)
-                print('Transforms calculated')
-            
-                with h5py.File(doc['file_path'], 'r+') as f:
-                    unregistered_line_intensities = f['/unregistered/line_intensities']
-                    registered_line_intensities_g = f.require_group('/registered/line_intensities')
-                    print('Applying tranforms to all elements')
-                    for element in unregistered_line_intensities:
-                        element_stack = unregistered_line_intensities[element][()]
-                        registered_element_stack = apply_transforms(element_stack, transforms)
-                        if element in registered_line_intensities_g:
-                            del registered_line_intensities_g[element]
-                            ds = registered_line_intensities_g.create_dataset(name=element, data=registered_element_stack)
-                            
-                            
-                        else:
-                            ds = registered_line_intensities_g.create_dataset(name=element, data=registered_element_stack)
-                        ds.attrs['units'] = 'a.u.'
-                        ds.attrs['ref_element'] = ref_element
-            except:
-                print('Calculating transforms failed')
+                register_stack(doc, parallel=parallel, n_workers=n_workers, method=method, prealign=prealign, materialise=materialise,
+                               use_cache=use_cache, on_failure=on_failure, show_failure=show_failure)
+            except Exception as e:
+                print(f'Calculating transforms failed: {e!r}')
                     
                     
     finally:
         client.close()
+
+
+def batch_register_stacks(output_dir : str, beamline : str = None, sample_name : str = None, scan_type : str = None, on_failure : str = 'identity',
+                          parallel : bool = False, n_workers : int = None, method : str = 'ecc', prealign : bool = False, materialise : bool = True, use_cache : bool = True) -> Dict[str, dict]:
+    """Registers all stacks matching the query without user interaction, for headless runs.
+    No figures are shown. Instead, for each stack a folder <beamline>_<sample_name>_<scan_type> is created in output_dir with
+    registration.json (ECC value and status of each pair of frames) and a PNG of each pair of frames that failed.
+    Stacks that fail completely (e.g. with on_failure='abort') are recorded and the remaining stacks are still registered.
+    A summary of all stacks is written to output_dir/registration_summary.json.
+    
+    Args:
+    - output_dir (str) : folder for the diagnostics
+    - beamline, sample_name, scan_type (str) : query of the stacks collection
+    - on_failure (str) : 'skip', 'identity' (default) or 'abort', see find_transforms
+    - the remaining arguments are passed to register_stack
+    returns:
+    - summary (dict) : per stack the status, number of pairs, failed pairs and skipped frames"""
+    client = pymongo.MongoClient('mongodb://localhost/')
+    db = client['in_situ_fluo']
+    stack_coll = db['stacks']
+    stack_docs = list(stack_coll.find(_stack_query(beamline, sample_name, scan_type)))
+    client.close()
+
+    os.makedirs(output_dir, exist_ok=True)
+    summary = {}
+    for doc in stack_docs:
+        name = f"{doc['beamline']}_{doc['sample_name']}_{doc['scan_type']}".replace(' ', '_').replace('/', '_')
+        print('Registering ' + doc['beamline'] + " " + doc['sample_name'] + " " + doc['scan_type'])
+        stack_dir = os.path.join(output_dir, name)
+        os.makedirs(stack_dir, exist_ok=True)
+        t0 = time.time()
+        report, error = [], None
+        try:
+            register_stack(doc, parallel=parallel, n_workers=n_workers, method=method, prealign=prealign, materialise=materialise,
+                           use_cache=use_cache, on_failure=on_failure, show_failure=False, diagnostics_dir=stack_dir, report=report)
+        except Exception as e:
+            error = repr(e)
+            print(f'Calculating transforms failed: {error}')
+        failed = [entry['pair'] for entry in report if entry['status'] not in ('ok', 'cached')]
+        summary[name] = {'file_path': doc['file_path'], 'status': 'failed' if error is not None else 'ok', 'error': error,
+                         'pairs': len(report), 'failed_pairs': failed, 'skipped_frames': skipped_frames(report), 'time_s': time.time() - t0}
+        with open(os.path.join(stack_dir, 'registration.json'), 'w') as fp:
+            json.dump({**summary[name], 'method': method, 'on_failure': on_failure, 'report': report}, fp, indent=2)
+
+    with open(os.path.join(output_dir, 'registration_summary.json'), 'w') as fp:
+        json.dump(summary, fp, indent=2)
+    n_failed = sum(s['status'] == 'failed' for s in summary.values())
+    n_pairs = sum(len(s['failed_pairs']) for s in summary.values())
+    print(f'Registered {len(summary) - n_failed} of {len(summary)} stacks, {n_pairs} pairs of frames failed. Diagnostics in {output_dir}')
+    return summary
         
         
 #%%
@@ -330,11 +980,42 @@ def test_stack_registration():
     test_folder = "/data/lazari/code/in-situ_anneal_AM_AlMnCrZr/in-situ_anneal_AM_AlMnCrZr/test_data/P06/process/fluo_stacks/fluo_stacks/jmesh ROI2/Mn_Ka"     
     stack = load_tif_stack(test_folder)
     stack = np.stack(stack, axis=0)
-    stack = crop_nans(stack)
+    stack = crop_nans_stack(stack)
     transforms = find_transforms(stack)
     registered = apply_transforms(stack, transforms)
 
 
+def benchmark_preprocess(n_frames : int = 100, shape : tuple = (300, 300), repeats : int = 5, seed : int = 0) -> dict:
+    """Times preprocess and crop_nans frame by frame against preprocess_stack and crop_nans_stack on a random NaN padded stack,
+    and checks that they give the same result. Returns the best time of each in seconds."""
+    rng = np.random.default_rng(seed)
+    stack = rng.gamma(2.0, 10.0, size=(n_frames,) + shape)
+    # pad the bottom and right of each frame with a random number of NaN rows and columns, like stacks of maps of different shapes
+    for frame, (pad_rows, pad_cols) in zip(stack, rng.integers(0, 10, size=(n_frames, 2))):
+        frame[shape[0]-pad_rows:] = np.nan
+        frame[:, shape[1]-pad_cols:] = np.nan
+
+    def best_time(func):
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - t0)
+        return min(times), result
+
+    timings = {}
+    timings['crop_nans'], cropped = best_time(lambda: crop_nans(stack))
+    timings['crop_nans_stack'], cropped_stack = best_time(lambda: crop_nans_stack(stack))
+    assert np.array_equal(cropped, cropped_stack)
+    timings['preprocess'], scaled = best_time(lambda: np.stack([preprocess(frame) for frame in cropped], axis=0))
+    timings['preprocess_stack'], scaled_stack = best_time(lambda: preprocess_stack(cropped))
+    assert np.abs(scaled.astype(int) - scaled_stack.astype(int)).max() <= 1
+    for name in ['crop_nans', 'preprocess']:
+        print(f"{name}: {timings[name]*1e3:.1f} ms, {name}_stack: {timings[name + '_stack']*1e3:.1f} ms "
+              f"({timings[name]/timings[name + '_stack']:.1f}x)")
+    return timings
+
+
 
     
 if __name__ == '__main__':
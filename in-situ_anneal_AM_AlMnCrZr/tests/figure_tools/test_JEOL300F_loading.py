@@ -0,0 +1,26 @@
+import os
+import pytest
+
+pytest.importorskip('hyperspy')
+import JEOL300F_loading
+
+
+# Test function for parse_image_number
+def test_parse_image_number():
+    assert JEOL300F_loading.parse_image_number('BF 40kx 0150.dm3') == 150
+    assert JEOL300F_loading.parse_image_number('session 2023/DF 10000.dm3') == 10000
+    assert JEOL300F_loading.parse_image_number('BF 40kx.dm3') is None
+
+
+# Test function for find_dm3_by_unique_number
+def test_find_dm3_by_unique_number(tmp_path):
+    names = ['BF 40kx 9999.dm3', 'BF 40kx 0150.dm3', 'day 2/DF 10000.dm3', 'day 2/SAED 10001.dm3']
+    for name in names:
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.touch()
+    catalog = JEOL300F_loading.dm3_catalog(str(tmp_path), refresh=True)
+    assert list(catalog['images']) == ['150', '9999', '10000', '10001']
+    assert JEOL300F_loading.find_dm3_by_unique_number(str(tmp_path), 10000) == os.path.join(str(tmp_path), 'day 2', 'DF 10000.dm3')
+    with pytest.raises(FileNotFoundError):
+        JEOL300F_loading.find_dm3_by_unique_number(str(tmp_path), 1000)
@@ -0,0 +1,48 @@
+import h5py
+import numpy as np
+import pytest
+import create_stacks
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find_one(self, query):
+        return next((doc for doc in self.docs if all(doc[key] == value for key, value in query.items())), None)
+
+
+class FakeDatabase:
+    def __init__(self, scan_docs):
+        self.scans = FakeCollection(scan_docs)
+
+
+def write_scans(tmp_path, shapes):
+    """One scan file per {dataset: shape} dict, with Mn_Ka, Cr_Ka and unix_time, and the scan documents"""
+    docs = []
+    for scan_number, scan_shapes in enumerate(shapes):
+        file_path = str(tmp_path / f'scan_{scan_number}.h5')
+        with h5py.File(file_path, 'w') as f:
+            for name, shape in scan_shapes.items():
+                f[name] = np.ones(shape)
+        docs.append({'beamline': 'P06', 'scan_number': scan_number, 'file_path': file_path, 'datasets': {
+            'unix_time': {'internal_path': 'unix_time', 'units': 's'},
+            'line_intensities': {element: {'internal_path': element, 'units': 'a.u.'} for element in ['Mn_Ka', 'Cr_Ka']}}})
+    return FakeDatabase(docs)
+
+
+# Test function for create_hdf5_stack
+def test_create_hdf5_stack_valid_extents(tmp_path):
+    db = write_scans(tmp_path, [{'Mn_Ka': (4, 5), 'Cr_Ka': (4, 5), 'unix_time': (4, 5)},
+                                {'Mn_Ka': (3, 6), 'Cr_Ka': (3, 6), 'unix_time': (3, 6)}])
+    create_stacks.create_hdf5_stack('P06', 'roi', 's', [0, 1], str(tmp_path), db)
+    with h5py.File(tmp_path / 's' / 'stacks' / 'roi.h5', 'r') as f:
+        assert f['/unregistered/valid_extents'][()].tolist() == [[4, 5], [3, 6]]
+        assert f['/unregistered/line_intensities/Cr_Ka'].shape == (2, 4, 6)
+
+
+def test_create_hdf5_stack_mismatched_shapes(tmp_path):
+    db = write_scans(tmp_path, [{'Mn_Ka': (4, 5), 'Cr_Ka': (4, 5), 'unix_time': (4, 5)},
+                                {'Mn_Ka': (3, 6), 'Cr_Ka': (4, 6), 'unix_time': (3, 6)}])
+    with pytest.raises(ValueError, match='Cr_Ka'):
+        create_stacks.create_hdf5_stack('P06', 'roi', 's', [0, 1], str(tmp_path), db)
@@ -0,0 +1,66 @@
+import numpy as np
+import precipitates
+
+
+def gaussian_frames(blobs, shape=(64, 64), noise=0.01, seed=0):
+    """One frame per (row, col, sigma) blob on a noisy background of 1"""
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    frames = 1 + noise*rng.standard_normal((len(blobs),) + shape)
+    for frame, (row, col, sigma) in zip(frames, blobs):
+        frame += np.exp(-((rows - row)**2 + (cols - col)**2)/(2*sigma**2))
+    return frames.astype(np.float32)
+
+
+# Test function for detect_blobs
+def test_detect_blobs_position_and_scale():
+    blobs = [(30, 37, 3), (20, 25, 5)]
+    sigmas = precipitates.blob_sigmas(1, 8)
+    found = precipitates.detect_blobs(gaussian_frames(blobs), sigmas, threshold=5, frame_offset=10)
+    assert len(found) == len(blobs)
+    for i, ((row, col, sigma), blob) in enumerate(zip(blobs, found[np.argsort(found[:, 0])])):
+        assert blob[0] == 10 + i
+        assert abs(blob[1] - row) <= 1 and abs(blob[2] - col) <= 1
+        # the DoG between sigma_i and sigma_i+1 responds most to blobs with a sigma between the two
+        scale = np.nonzero(sigmas == blob[3])[0][0]
+        assert sigmas[scale] <= sigma < sigmas[scale + 1]
+        assert np.isclose(blob[4], blob[3]*np.sqrt(2))
+
+
+def test_detect_blobs_ignores_nan_edges():
+    frames = gaussian_frames([(30, 37, 3)])
+    frames[:, :, :10] = np.nan
+    found = precipitates.detect_blobs(frames, precipitates.blob_sigmas(1, 8))
+    assert len(found) == 1
+    assert abs(found[0, 1] - 30) <= 1 and abs(found[0, 2] - 37) <= 1
+
+
+# Test function for link_tracks
+def test_link_tracks_max_gap():
+    # a precipitate seen in frames 0, 1 and 3 (missed in frame 2), and one far away appearing in frame 3
+    blobs = np.array([[0, 10, 10], [1, 10.5, 10], [3, 11, 10.5], [3, 40, 40]], dtype=np.float64)
+    assert precipitates.link_tracks(blobs, max_distance=3, max_gap=1).tolist() == [0, 0, 0, 1]
+    assert precipitates.link_tracks(blobs, max_distance=3, max_gap=0).tolist() == [0, 0, 1, 2]
+
+
+def test_link_tracks_one_blob_per_track():
+    # two blobs close to the same track: the closest one continues it, the other starts a new track
+    blobs = np.array([[0, 10, 10], [1, 10, 11], [1, 10, 12]], dtype=np.float64)
+    assert precipitates.link_tracks(blobs, max_distance=3).tolist() == [0, 0, 1]
+
+
+# Test function for frame_counts
+def test_frame_counts_new_tracks():
+    # columns frame, row, col, sigma, radius, response, intensity, track
+    blobs = np.array([
+        [0, 10, 10, 1, 1, 9, 2, 0],
+        [1, 10, 10, 1, 2, 9, 4, 0],
+        [1, 30, 30, 1, 4, 9, 6, 1],
+        [3, 10, 10, 1, 3, 9, 2, 0],
+        [3, 50, 50, 1, 5, 9, 8, 2],
+    ], dtype=np.float64)
+    counts = precipitates.frame_counts(blobs, n_frames=5)
+    assert counts['count'].tolist() == [1, 2, 0, 2, 0]
+    assert counts['new_tracks'].tolist() == [1, 1, 0, 1, 0]
+    assert np.allclose(counts['mean_radius'], [1, 3, np.nan, 4, np.nan], equal_nan=True)
+    assert np.allclose(counts['mean_intensity'], [2, 5, np.nan, 5, np.nan], equal_nan=True)
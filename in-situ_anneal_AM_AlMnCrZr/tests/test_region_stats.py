@@ -0,0 +1,42 @@
+import warnings
+import h5py
+import numpy as np
+import region_stats
+
+
+# Test function for region_stats
+def test_region_stats_matches_per_label_loop():
+    rng = np.random.default_rng(0)
+    n_frames, rows, cols = 5, 40, 36
+    elements = ['Mn_Ka', 'Cr_Ka']
+    data = {element: rng.random((n_frames, rows, cols)) for element in elements}
+    data['Mn_Ka'][:, :3] = np.nan # NaN padding
+    data['Cr_Ka'][rng.random((n_frames, rows, cols)) < 0.1] = np.nan
+    unix_time = 1.7e9 + 60*np.arange(n_frames)[:, None, None] + rng.random((n_frames, rows, cols))
+    unix_time[:, -2:] = np.nan
+    # negative and non-contiguous labels; label 3 only covers NaN padding of Mn_Ka
+    labels = rng.choice([-1, 0, 5, 12], size=(rows, cols))
+    labels[:3, :4] = 3
+
+    with h5py.File('region_stats_test.h5', 'w', driver='core', backing_store=False) as f:
+        for element in elements:
+            f[f'/registered/line_intensities/{element}'] = data[element]
+        f['/registered/unix_time'] = unix_time
+        df = region_stats.region_stats(f, labels, elements, name='test', block_rows=7)
+        assert '/region_stats/test' in f
+
+    assert sorted(df['label'].unique()) == [0, 3, 5, 12]
+    assert len(df) == len(elements)*n_frames*4
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for row in df.itertuples():
+            values = data[row.element][row.frame][labels == row.label]
+            count = np.count_nonzero(~np.isnan(values))
+            assert row.count == count
+            if count == 0:
+                assert np.isnan(row.sum) and np.isnan(row.mean) and np.isnan(row.std)
+            else:
+                assert np.isclose(row.sum, np.nansum(values))
+                assert np.isclose(row.mean, np.nanmean(values))
+                assert np.isclose(row.std, np.nanstd(values))
+            assert np.isclose(row.unix_time, np.nanmean(unix_time[row.frame][labels == row.label]))
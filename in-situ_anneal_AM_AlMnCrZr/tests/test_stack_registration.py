@@ -0,0 +1,62 @@
+import cv2
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+import stack_registration
+
+
+def shifted_stack(shifts, size=400, crop=60, seed=0):
+    """Frames of a smooth random texture translated by the cumulative (x, y) shifts, cropped so that no frame has empty borders"""
+    rng = np.random.default_rng(seed)
+    base = gaussian_filter(rng.random((size, size)), 3).astype(np.float32)
+    frames = []
+    offset = np.zeros(2)
+    for shift in shifts:
+        offset += shift
+        M = np.float32([[1, 0, offset[0]], [0, 1, offset[1]]])
+        frames.append(cv2.warpAffine(base, M, (size, size))[crop:size - crop, crop:size - crop])
+    return np.array(frames)
+
+
+# Test function for find_one_transform_pyramid
+def test_pyramid_converges_at_every_level():
+    for shift in [(3, 2), (10, 5)]:
+        stack = shifted_stack([(0, 0), shift])
+        stats = []
+        transform, ecc = stack_registration.find_one_transform_pyramid(stack[0], stack[1], stats=stats, return_ecc=True)
+        assert len(stats) == stack_registration.PYRAMID_LEVELS
+        assert all(level['converged'] for level in stats)
+        assert not any(level['fallback'] for level in stats)
+        assert np.allclose(transform[:, 2], shift, atol=0.1)
+        assert ecc > 0.99
+
+
+def test_pyramid_keeps_estimate_of_failed_level():
+    # the coarsest level does not converge for this shift; the finer levels must start from the previous estimate, not from
+    # the matrix findTransformECC left behind
+    stack = shifted_stack([(0, 0), (6.5, -4)])
+    stats = []
+    transform = stack_registration.find_one_transform_pyramid(stack[0], stack[1], stats=stats)
+    assert not stats[0]['converged']
+    assert all(level['converged'] for level in stats[1:])
+    assert not any(level['fallback'] for level in stats)
+    assert np.allclose(transform[:, 2], (6.5, -4), atol=0.1)
+
+
+# Test function for find_transforms
+def test_find_transforms_pyramid_prealign_without_fallback():
+    rng = np.random.default_rng(1)
+    stack = shifted_stack(np.concatenate(([(0, 0)], rng.normal(0, 6, (7, 2)))))
+    stats = []
+    transforms = stack_registration.find_transforms(stack, method='pyramid', stats=stats, prealign=True, show_failure=False)
+    assert len(transforms) == len(stack)
+    assert len(stats) == len(stack) - 1
+    assert stack_registration.pyramid_fallbacks(stats) == 0
+
+
+def test_find_transforms_abort_names_the_pair():
+    stack = shifted_stack([(0, 0), (3, 2), (3, 2)])
+    stack[2] = 1 # a blank frame, nothing to register to
+    with pytest.raises(RuntimeError, match=r'^registration failed between frames 1 and 2: ') as info:
+        stack_registration.find_transforms(stack, on_failure='abort', show_failure=False)
+    assert info.value.__cause__ is not None